@@ -1,4 +1,5 @@
 import streamlit as st
+from utils.resources import PROFILE_RERUNS, report
 
 st.set_page_config(
     page_title="FullStackGPT Home",
@@ -21,3 +22,7 @@ Here are the apps I made:
 - [ ] [InvestorGPT](/InvestorGPT)
 """
 )
+
+if PROFILE_RERUNS:
+    with st.expander("Profile"):
+        st.json(report())
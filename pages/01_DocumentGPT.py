@@ -1,15 +1,25 @@
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.document_loaders import UnstructuredFileLoader
-from langchain.embeddings import CacheBackedEmbeddings, OpenAIEmbeddings
+from langchain.embeddings import OpenAIEmbeddings
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.output import ChatGenerationChunk, GenerationChunk
 from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.storage import LocalFileStore
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores.faiss import FAISS
-from langchain.chat_models import ChatOpenAI
 import streamlit as st
+import os
+import time
+from utils.callbacks import StreamingCallbackHandler
+from utils.content_hash import index_key
+from utils.embedding_scheduler import EmbeddingScheduler
+from utils.faiss_cache import load_index, save_index
+from utils.ingest import build_vector_store, iter_chunks
+from utils.llm_cache import NamespacedChatOpenAI, setup_llm_cache
+from utils.resources import get_resource, record_rerun
+from utils.semantic_cache import SemanticCache
+from utils.sqlite_store import cached_embeddings
+
+rerun_started_at = time.perf_counter()
+
+setup_llm_cache()
 
 st.set_page_config(
     page_title="DocumentGPT",
@@ -17,22 +27,22 @@ st.set_page_config(
 )
 
 
-class ChatCallbackHandler(BaseCallbackHandler):
-    message = ""
-
+class ChatCallbackHandler(StreamingCallbackHandler):
     def on_llm_start(self, *arg, **kwargs):
+        super().on_llm_start(*arg, **kwargs)
         self.message_box = st.empty()
 
-    def on_llm_end(self, *arg, **kwargs):
+    def on_llm_end(self, response, *arg, **kwargs):
+        super().on_llm_end(response, *arg, **kwargs)
         save_message(self.message, "ai")
 
-    def on_llm_new_token(self, token, *args, **kwargs):
-        self.message += token
-        self.message_box.markdown(self.message)
+    def show(self, message):
+        self.message_box.markdown(message)
 
 
-llm = ChatOpenAI(
+llm = NamespacedChatOpenAI(
     temperature=0.1,
+    cache_namespace="DocumentGPT",
     streaming=True,
     callbacks=[
         ChatCallbackHandler(),
@@ -40,25 +50,40 @@ llm = ChatOpenAI(
 )
 
 
+splitter_settings = {
+    "separator": "\n",
+    "chunk_size": 500,
+    "chunk_overlap": 100,
+}
+
+
 @st.cache_data(show_spinner="Embedding file...")
 def embed_file(file):
     file_content = file.read()
-    file_path = f"./.cache/files/{file.name}"
-    with open(file_path, "wb") as f:
-        f.write(file_content)
-    cache_dir = LocalFileStore(f"./.cache/embeddings/{file.name}")
-    splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=500,
-        chunk_overlap=100,
-    )
-    loader = UnstructuredFileLoader(file_path)
-    docs = loader.load_and_split(text_splitter=splitter)
     embeddings = OpenAIEmbeddings()
-    cached_embeddings = CacheBackedEmbeddings.from_bytes_store(embeddings, cache_dir)
-    vector_store = FAISS.from_documents(docs, cached_embeddings)
+    key = index_key(file_content, model=embeddings.model, **splitter_settings)
+    index_path = f"./.cache/faiss/{key}"
+    vector_store = load_index(index_path, embeddings)
+    if vector_store is None:
+        extension = os.path.splitext(file.name)[1]
+        file_path = f"./.cache/files/{key}{extension}"
+        os.makedirs("./.cache/files", exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(file_content)
+        splitter = CharacterTextSplitter(**splitter_settings)
+        scheduler = get_resource(
+            f"EmbeddingScheduler.{embeddings.model}",
+            lambda: EmbeddingScheduler(embeddings),
+        )
+        embeddings_cache = cached_embeddings(scheduler, embeddings.model)
+        vector_store = build_vector_store(
+            iter_chunks(file_path, splitter), embeddings_cache
+        )
+        save_index(vector_store, index_path)
+        # st.cache_data pickles the retriever, which the scheduler can't be.
+        vector_store.embedding_function = embeddings
     retriever = vector_store.as_retriever()
-    return retriever
+    return retriever, key
 
 
 def save_message(message, role):
@@ -109,6 +134,8 @@ st.markdown(
     """
 )
 
+ANSWER_CACHE_THRESHOLD = 0.97
+
 with st.sidebar:
     file = st.file_uploader(
         "Upload a .txt .pdf .md or .docx file",
@@ -116,24 +143,36 @@ with st.sidebar:
     )
 
 if file:
-    retriever = embed_file(file)
+    retriever, index_version = embed_file(file)
     send_message("준비가 다 되었습니다. 궁금하신 점을 질문하세요 :)", "ai", save=False)
     paint_history()
     message = st.chat_input("첨부하신 파일에 대해 궁금하신 점을 입력하세요!")
     if message:
         send_message(message, "human")
 
-        chain = (
-            {
-                "context": retriever | RunnableLambda(format_docs),
-                "question": RunnablePassthrough(),
-            }
-            | prompt
-            | llm
+        answer_cache = SemanticCache(
+            "DocumentGPT", OpenAIEmbeddings(), threshold=ANSWER_CACHE_THRESHOLD
         )
-        with st.chat_message("ai"):
-            response = chain.invoke(message)
+        answer, message_vector = answer_cache.lookup(index_version, message)
+        if answer:
+            send_message(answer, "ai")
+        else:
+            chain = (
+                {
+                    "context": retriever | RunnableLambda(format_docs),
+                    "question": RunnablePassthrough(),
+                }
+                | prompt
+                | llm
+            )
+            with st.chat_message("ai"):
+                response = chain.invoke(message)
+            answer_cache.update(
+                index_version, message, message_vector, response.content
+            )
 
 
 else:
     st.session_state["messages"] = []
+
+record_rerun("DocumentGPT", rerun_started_at)
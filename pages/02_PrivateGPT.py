@@ -1,13 +1,16 @@
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain.document_loaders import UnstructuredFileLoader
-from langchain.embeddings import CacheBackedEmbeddings, OllamaEmbeddings
+from langchain.embeddings import OllamaEmbeddings
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.storage import LocalFileStore
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores.faiss import FAISS
 from langchain.chat_models import ChatOllama
 import streamlit as st
+import time
+from utils.ingest import build_vector_store, iter_chunks
+from utils.resources import record_rerun
+from utils.sqlite_store import cached_embeddings
+
+rerun_started_at = time.perf_counter()
 
 st.set_page_config(
     page_title="PrivateGPT",
@@ -45,17 +48,16 @@ def embed_file(file):
     file_path = f"./.cache/private_files/{file.name}"
     with open(file_path, "wb") as f:
         f.write(file_content)
-    cache_dir = LocalFileStore(f"./.cache/private_embeddings/{file.name}")
     splitter = CharacterTextSplitter(
         separator="\n",
         chunk_size=500,
         chunk_overlap=100,
     )
-    loader = UnstructuredFileLoader(file_path)
-    docs = loader.load_and_split(text_splitter=splitter)
     embeddings = OllamaEmbeddings(model="mistral:latest")
-    cached_embeddings = CacheBackedEmbeddings.from_bytes_store(embeddings, cache_dir)
-    vector_store = FAISS.from_documents(docs, cached_embeddings)
+    embeddings_cache = cached_embeddings(embeddings, f"ollama/{embeddings.model}")
+    vector_store = build_vector_store(
+        iter_chunks(file_path, splitter), embeddings_cache
+    )
     retriever = vector_store.as_retriever()
     return retriever
 
@@ -131,3 +133,5 @@ if file:
 
 else:
     st.session_state["messages"] = []
+
+record_rerun("PrivateGPT", rerun_started_at)
@@ -1,26 +1,26 @@
 import streamlit as st
-import json
+import itertools
+import logging
+import math
+import re
+import time
+from operator import itemgetter
 from langchain.callbacks import StdOutCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.document_loaders import UnstructuredFileLoader
+from langchain.output_parsers.openai_functions import JsonOutputFunctionsParser
 from langchain.prompts import ChatPromptTemplate
-from langchain.retrievers import WikipediaRetriever
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.schema import BaseOutputParser
+from langchain.schema.runnable import RunnableLambda
+from utils.content_hash import index_key
+from utils.llm_cache import NamespacedChatOpenAI, setup_llm_cache
+from utils.quiz_store import QuizStore, start_pregeneration
+from utils.resources import get_resource, lazy_import, record_rerun
 
+rerun_started_at = time.perf_counter()
 
-class JsonOutputParser(BaseOutputParser):
-    def parse(self, text):
-        text = (
-            text.replace("```", "")
-            .replace("json", "")
-            .replace(", ]", "]")
-            .replace(", }", "}")
-        )
-        return json.loads(text)
+logger = logging.getLogger(__name__)
 
+setup_llm_cache()
 
-output_parser = JsonOutputParser()
 
 st.set_page_config(
     page_title="QuizGPT",
@@ -29,13 +29,17 @@ st.set_page_config(
 
 st.title("QuizGPT")
 
-llm = ChatOpenAI(
-    temperature=0.1,
-    model="gpt-3.5-turbo-0125",
-    streaming=True,
-    callbacks=[
-        StdOutCallbackHandler(),
-    ],
+llm = get_resource(
+    "QuizGPT.llm",
+    lambda: NamespacedChatOpenAI(
+        temperature=0.1,
+        cache_namespace="QuizGPT",
+        model="gpt-3.5-turbo-0125",
+        streaming=True,
+        callbacks=[
+            StdOutCallbackHandler(),
+        ],
+    ),
 )
 
 
@@ -50,14 +54,15 @@ questions_prompt = ChatPromptTemplate.from_messages(
             """
              #명령문
              당신은 퀴즈 선생님입니다. 
-             [context]를 기반으로 하여 반드시 10개의 질문을 만들어야 합니다.
-             내용이 적더라도 10개의 질문을 만드는 것이 목표입니다.
+             [context]를 기반으로 하여 반드시 {count}개의 질문을 만들어야 합니다.
+             내용이 적더라도 {count}개의 질문을 만드는 것이 목표입니다.
              만들어야 하는 질문은 [context]에 관련되어야만 하며 기존의 학습된 데이터가 포함되면 안됩니다. 
              질문의 내용은 사용자에게 [context]의 지식을 확인하기 위함입니다.
              
              #제약조건
              각각의 질문마다 4가지 보기를 제공합니다. 그 중 세 가지는 [context]와 일치하지 않아야 합니다. 나머지 하나는 [context]와 일치하는 사실이어야 합니다.
-             [context]와 일치하는 사실은 보기 뒤에 (o) 표시를 하여야 합니다.
+             만든 질문은 create_quiz 함수로 전달하며, [context]와 일치하는 보기만 correct 를 true 로 설정합니다.
+             #예시 의 (o) 표시는 정답 보기를 뜻합니다.
              
              #예시
              질문: 바다의 색깔은 무엇인가요?
@@ -72,6 +77,10 @@ questions_prompt = ChatPromptTemplate.from_messages(
              질문: Julius Ceasar 는 누구일까요?
              보기: 로마의 황제(o) | 화가 | 배우 | 모델
              
+             #이미 출제된 질문
+             아래 질문과 겹치지 않는 새로운 질문을 만드세요.
+             {exclude}
+             
              시작하세요!
              
              [context]:{context}
@@ -80,131 +89,54 @@ questions_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-questions_chain = {"context": format_docs} | questions_prompt | llm
+quiz_function = {
+    "name": "create_quiz",
+    "description": "function that takes a list of questions and answers and returns a quiz",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "answers": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "answer": {"type": "string"},
+                                    "correct": {"type": "boolean"},
+                                },
+                                "required": ["answer", "correct"],
+                            },
+                        },
+                    },
+                    "required": ["question", "answers"],
+                },
+            }
+        },
+        "required": ["questions"],
+    },
+}
 
-formatting_prompt = ChatPromptTemplate.from_messages(
-    [
-        (
-            "system",
-            """
-                #명령문
-                당신은 강력한 formatting 알고리즘 입니다.
-                당신은 #예시질문 을 JSON format 으로 변환합니다.
-                (o) 표시가 되어 있는 것이 정답입니다.
-                
-                #예시질문
-                질문: 바다의 색깔은 무엇인가요?
-                보기: 빨강 | 노랑 | 초록 | 파랑(o)
-                
-                질문: Goergia 의 수도는 어디인가요?
-                보기: Baku | Tbilisi(o) | Manila | Beirut
-                
-                질문: 영화 Avatar 의 출시연도는 언제인가요?
-                보기: 2007년 | 2001년 | 2009년(o) | 1998년
-
-                질문: Julius Ceasar 는 누구일까요?
-                보기: 로마의 황제(o) | 화가 | 배우 | 모델
-                
-                #예시Output
-                ```json
-                {{ "questions": [
-                        {{
-                            "question": "바다의 색깔은 무엇인가요?",
-                            "answers": [
-                                    {{
-                                        "answer": "빨강",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "노랑",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "초록",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "파랑",
-                                        "correct": true
-                                    }},
-                            ]
-                        }},
-                                    {{
-                            "question": "Goergia 의 수도는 어디인가요?",
-                            "answers": [
-                                    {{
-                                        "answer": "Baku",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "Tbilisi",
-                                        "correct": true
-                                    }},
-                                    {{
-                                        "answer": "Manila",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "Beirut",
-                                        "correct": false
-                                    }},
-                            ]
-                        }},
-                                    {{
-                            "question": "영화 Avatar 의 출시연도는 언제인가요?",
-                            "answers": [
-                                    {{
-                                        "answer": "2007년",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "2001년",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "2009년",
-                                        "correct": true
-                                    }},
-                                    {{
-                                        "answer": "1998년",
-                                        "correct": false
-                                    }},
-                            ]
-                        }},
-                        {{
-                            "question": "Julius Ceasar 는 누구일까요?",
-                            "answers": [
-                                    {{
-                                        "answer": "로마의 황제",
-                                        "correct": true
-                                    }},
-                                    {{
-                                        "answer": "화가",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "배우",
-                                        "correct": false
-                                    }},
-                                    {{
-                                        "answer": "모델",
-                                        "correct": false
-                                    }},
-                            ]
-                        }}
-                    ]
-                }}
-                ```
-                시작하세요!
-
-                질문: {context}
-
-            """,
-        )
-    ]
+# Forcing the function call returns the quiz as JSON in a single request.
+quiz_llm = llm.bind(
+    function_call={"name": "create_quiz"},
+    functions=[quiz_function],
 )
 
-formatting_chain = formatting_prompt | llm
+questions_chain = (
+    {
+        "context": itemgetter("docs") | RunnableLambda(format_docs),
+        "count": itemgetter("count"),
+        "exclude": itemgetter("exclude"),
+    }
+    | questions_prompt
+    | quiz_llm
+    | JsonOutputFunctionsParser()
+)
 
 
 @st.cache_data(show_spinner="Loading file...")
@@ -218,29 +150,175 @@ def split_file(file):
         chunk_size=500,
         chunk_overlap=100,
     )
-    loader = UnstructuredFileLoader(file_path)
-    docs = loader.load_and_split(text_splitter=splitter)
+    # The ingestion pipeline pulls in unstructured, only load it for uploads.
+    iter_chunks = lazy_import("utils.ingest", "iter_chunks")
+    docs = list(iter_chunks(file_path, splitter))
     return docs
 
 
-@st.cache_data(show_spinner="Making Quiz...")
-def run_quiz_chain(_docs, topic):
-    chain = {"context": questions_chain} | formatting_chain | output_parser
-    return chain.invoke(_docs)
+GROUP_TOKEN_BUDGET = 3000
+QUESTIONS_PER_GROUP = 5
+MAX_CONCURRENCY = 8
+DEFAULT_COUNT = 10
+POPULAR_TOPICS = [
+    "대한민국",
+    "세종대왕",
+    "인공지능",
+    "태양계",
+    "제2차 세계 대전",
+]
 
 
-@st.cache_data(show_spinner="Searching Wikipedia...")
-def wiki_search(term):
-    retriever = WikipediaRetriever(
+def group_docs(docs):
+    groups = [[]]
+    tokens = 0
+    for doc in docs:
+        doc_tokens = llm.get_num_tokens(doc.page_content)
+        if groups[-1] and tokens + doc_tokens > GROUP_TOKEN_BUDGET:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(doc)
+        tokens += doc_tokens
+    return groups
+
+
+def sample_groups(groups, count, offset=0):
+    # Spread the sampled groups evenly over the whole document, shifting them
+    # by the offset so every quiz of the bank covers different parts.
+    size = min(len(groups), math.ceil(count / QUESTIONS_PER_GROUP))
+    return [
+        groups[(i * len(groups) // size + offset) % len(groups)] for i in range(size)
+    ]
+
+
+def merge_questions(quizzes, count):
+    questions = []
+    seen = set()
+    # Round robin over the groups so every part of the document is covered.
+    for questions_round in itertools.zip_longest(
+        *(quiz["questions"] for quiz in quizzes)
+    ):
+        for question in questions_round:
+            if question is None:
+                continue
+            key = re.sub(r"\W", "", question["question"]).lower()
+            if key not in seen:
+                seen.add(key)
+                questions.append(question)
+    return {"questions": questions[:count]}
+
+
+def stream_quiz(inputs):
+    preview = st.empty()
+    quiz = {}
+    # The parser yields the partial quiz on every token, every question but
+    # the last one is already complete.
+    for quiz in questions_chain.stream(inputs):
+        questions = quiz.get("questions", [])[:-1]
+        preview.markdown(
+            "\n".join(
+                f"{num + 1}. {question['question']}"
+                for num, question in enumerate(questions)
+            )
+        )
+    preview.empty()
+    return quiz
+
+
+def format_exclude(quizzes):
+    questions = [
+        question["question"] for quiz in quizzes for question in quiz["questions"]
+    ]
+    return "\n".join(questions) if questions else "없음"
+
+
+def generate_quiz(docs, count, previous=(), stream=False):
+    groups = sample_groups(group_docs(docs), count, offset=len(previous))
+    exclude = format_exclude(previous)
+    if stream and len(groups) == 1:
+        return merge_questions(
+            [stream_quiz({"docs": groups[0], "count": count, "exclude": exclude})],
+            count,
+        )
+    per_group = math.ceil(count / len(groups)) + 1
+    results = questions_chain.batch(
+        [{"docs": group, "count": per_group, "exclude": exclude} for group in groups],
+        config={"max_concurrency": MAX_CONCURRENCY},
+        return_exceptions=True,
+    )
+    quizzes = []
+    for group, result in enumerate(results):
+        if isinstance(result, Exception):
+            logger.warning(
+                "Generating questions for group %s of %s failed: %s",
+                group + 1,
+                len(groups),
+                result,
+            )
+        else:
+            quizzes.append(result)
+    if not quizzes:
+        raise results[0]
+    return merge_questions(quizzes, count)
+
+
+def quiz_key(docs, count):
+    return index_key(
+        format_docs(docs).encode("utf-8"),
+        count=count,
+        model=llm.model_name,
+        prompt=questions_prompt.messages[0].prompt.template,
+    )
+
+
+def load_quiz(store, docs, count, exclude=None):
+    key = quiz_key(docs, count)
+    if exclude is None:
+        quiz = store.pick(key)
+        if quiz:
+            return quiz
+    elif store.is_full(key):
+        return store.pick(key, exclude)
+    with st.spinner("Making Quiz..."):
+        quiz = generate_quiz(docs, count, store.quizzes(key), stream=True)
+    store.add(key, quiz)
+    return quiz
+
+
+def search_wikipedia(term):
+    retriever = lazy_import("langchain.retrievers", "WikipediaRetriever")(
         top_k_results=3,
         lang="ko",
     )
     return retriever.get_relevant_documents(term)
 
 
+def prepare_topic(topic):
+    docs = search_wikipedia(topic)
+    return quiz_key(docs, DEFAULT_COUNT), lambda previous: generate_quiz(
+        docs, DEFAULT_COUNT, previous
+    )
+
+
+@st.cache_resource
+def quiz_bank():
+    store = QuizStore()
+    start_pregeneration(store, POPULAR_TOPICS, prepare_topic)
+    return store
+
+
+@st.cache_data(show_spinner="Searching Wikipedia...")
+def wiki_search(term):
+    return search_wikipedia(term)
+
+
+store = quiz_bank()
+
+
 with st.sidebar:
     docs = None
     topic = None
+    count = st.slider("문제 수", min_value=5, max_value=30, value=DEFAULT_COUNT)
     choice = st.selectbox(
         "Choose what you want to use.",
         (
@@ -258,6 +336,7 @@ with st.sidebar:
             docs = split_file(file)
     else:
         topic = st.text_input("")
+        st.caption("추천 주제: " + ", ".join(POPULAR_TOPICS))
         if topic:
             docs = wiki_search(topic)
 
@@ -273,7 +352,15 @@ if not docs:
     """
     )
 else:
-    response = run_quiz_chain(docs, topic if topic else file.name)
+    key = quiz_key(docs, count)
+    if st.session_state.get("quiz_key") != key:
+        st.session_state["quiz_key"] = key
+        st.session_state["quiz"] = load_quiz(store, docs, count)
+    if st.button("다른 퀴즈 풀기"):
+        st.session_state["quiz"] = load_quiz(
+            store, docs, count, exclude=st.session_state["quiz"]
+        )
+    response = st.session_state["quiz"]
     with st.form("questions_form"):
         for num, question in enumerate(response["questions"]):
             st.write(f"{num + 1}. {question['question']}")
@@ -304,3 +391,5 @@ else:
                             )
 
         button = st.form_submit_button(label="제출하기")
+
+record_rerun("QuizGPT", rerun_started_at)
@@ -1,18 +1,48 @@
-from langchain.chat_models import ChatOpenAI
-from langchain.document_loaders import AsyncChromiumLoader, SitemapLoader
-from langchain.document_transformers import Html2TextTransformer
-from langchain.embeddings import CacheBackedEmbeddings, OpenAIEmbeddings
+import asyncio
+import logging
+import re
+import time
+from langchain.embeddings import OpenAIEmbeddings
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
-from langchain.storage import LocalFileStore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores.faiss import FAISS
 import streamlit as st
 from bs4 import BeautifulSoup
-import html2text
+from utils.callbacks import StreamingCallbackHandler
+from utils.embedding_scheduler import EmbeddingScheduler
+from utils.llm_cache import NamespacedChatOpenAI, setup_llm_cache
+from utils.resources import get_resource, lazy_import, record_rerun
+from utils.semantic_cache import SemanticCache
+from utils.sqlite_store import cached_embeddings
 
-llm = ChatOpenAI(
+rerun_started_at = time.perf_counter()
+
+logger = logging.getLogger(__name__)
+
+setup_llm_cache()
+
+
+class ChatCallbackHandler(StreamingCallbackHandler):
+    def on_llm_start(self, *arg, **kwargs):
+        super().on_llm_start(*arg, **kwargs)
+        self.message_box = st.empty()
+
+    def show(self, message):
+        self.message_box.markdown(message.replace("$", "\$"))
+
+
+llm = get_resource(
+    "SiteGPT.llm",
+    lambda: NamespacedChatOpenAI(temperature=0.1, cache_namespace="SiteGPT"),
+)
+
+choose_llm = NamespacedChatOpenAI(
     temperature=0.1,
+    cache_namespace="SiteGPT",
+    streaming=True,
+    callbacks=[
+        ChatCallbackHandler(),
+    ],
 )
 
 answers_prompt = ChatPromptTemplate.from_template(
@@ -47,35 +77,71 @@ answers_prompt = ChatPromptTemplate.from_template(
 )
 
 
+MAX_CONCURRENCY = 8
+ANSWER_TIMEOUT = 20
+# Sites cover many close topics, reuse answers only for near rewordings.
+ANSWER_CACHE_THRESHOLD = 0.98
+
+
+def parse_score(answer):
+    match = re.search(r"Score:\s*(\d)", answer)
+    return int(match.group(1)) if match else None
+
+
+async def aget_answers(question, docs, answers_box):
+    answers_chain = answers_prompt | llm
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def get_answer(doc):
+        async with semaphore:
+            result = await answers_chain.ainvoke(
+                {
+                    "question": question,
+                    "context": doc.page_content,
+                }
+            )
+        answers_box.markdown(
+            f"{result.content} \n\n Source:{doc.metadata['source']}".replace("$", "\$")
+        )
+        return {
+            "answer": result.content,
+            "source": doc.metadata["source"],
+            "date": doc.metadata["lastmod"],
+        }
+
+    tasks = [asyncio.create_task(get_answer(doc)) for doc in docs]
+    done, pending = await asyncio.wait(tasks, timeout=ANSWER_TIMEOUT)
+    answers = []
+    complete = not pending
+    for task, doc in zip(tasks, docs):
+        source = doc.metadata["source"]
+        if task in pending:
+            # Stragglers past the latency budget are dropped instead of awaited.
+            task.cancel()
+            logger.warning(
+                "Answering from %s timed out after %ss", source, ANSWER_TIMEOUT
+            )
+        elif task.exception():
+            complete = False
+            logger.warning("Answering from %s failed: %s", source, task.exception())
+        else:
+            answers.append(task.result())
+    answers = [answer for answer in answers if parse_score(answer["answer"]) != 0]
+    return answers, complete
+
+
 def get_answers(inputs):
     docs = inputs["docs"]
     question = inputs["question"]
-    answers_chain = answers_prompt | llm
-    # answers = []
-    # for doc in docs:
-    #     result = answers_chain.invoke(
-    #         {
-    #             "question": question,
-    #             "context": doc.page_content,
-    #         }
-    #     )
-    #     answers.append(result.content)
-
+    answers_box = st.expander("출처별 답변")
+    answers, complete = asyncio.run(aget_answers(question, docs, answers_box))
+    if not answers:
+        st.error("웹사이트에서 답변을 찾지 못했습니다. 잠시 후 다시 시도해주세요.")
+        st.stop()
     return {
         "question": question,
-        "answers": [
-            {
-                "answer": answers_chain.invoke(
-                    {
-                        "question": question,
-                        "context": doc.page_content,
-                    }
-                ).content,
-                "source": doc.metadata["source"],
-                "date": doc.metadata["lastmod"],
-            }
-            for doc in docs
-        ],
+        "answers": answers,
+        "complete": complete,
     }
 
 
@@ -107,7 +173,7 @@ choose_prompt = ChatPromptTemplate.from_messages(
 def choose_answer(inputs):
     answers = inputs["answers"]
     question = inputs["question"]
-    choose_chain = choose_prompt | llm
+    choose_chain = choose_prompt | choose_llm
     condensed = "\n\n".join(
         f"{answer['answer']} \n Source:{answer['source']} \n Date:{answer['date']}\n"
         for answer in answers
@@ -139,25 +205,31 @@ def parse_page(soup: BeautifulSoup):
     show_spinner="웹사이트를 읽고 있습니다. 이 작업은 최초 1회만 진행됩니다."
 )
 def load_website(url):
-    cache_dir = LocalFileStore(f"./.cache/site_embeddings/{url}")
     splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
         chunk_size=1000, chunk_overlap=200
     )
-    loader = SitemapLoader(
+    embeddings = OpenAIEmbeddings()
+    # One scheduler per model, so every session shares its rate limit.
+    scheduler = get_resource(
+        f"EmbeddingScheduler.{embeddings.model}",
+        lambda: EmbeddingScheduler(embeddings),
+    )
+    embeddings_cache = cached_embeddings(scheduler, embeddings.model)
+    # Loading the site index pulls in FAISS, only pay for it once a URL is set.
+    update_site_index = lazy_import("utils.site_index", "update_site_index")
+    vector_store, index_version, stats = update_site_index(
         url,
-        restrict_to_same_domain=False,
-        # filter_urls=[
-        #     r"^(.*\/blog\/).*",
-        # ],
-        parsing_function=parse_page,
+        parse_page,
+        splitter,
+        embeddings_cache,
     )
-    loader.requests_per_second = 1
-    loader.requests_kwargs = {"verify": False}
-    docs = loader.load_and_split(text_splitter=splitter)
-    embeddings = OpenAIEmbeddings()
-    cached_embeddings = CacheBackedEmbeddings.from_bytes_store(embeddings, cache_dir)
-    vector_store = FAISS.from_documents(docs, cached_embeddings)
-    return vector_store.as_retriever()
+    # st.cache_data pickles the retriever, which the scheduler can't be.
+    vector_store.embedding_function = embeddings
+    SemanticCache(url, embeddings).invalidate(index_version)
+    st.sidebar.caption(
+        f"{stats['pages']}개 페이지 중 {stats['updated']}개 페이지를 새로 읽었습니다."
+    )
+    return vector_store.as_retriever(), index_version
 
 
 st.set_page_config(
@@ -167,46 +239,41 @@ st.set_page_config(
 
 st.title("SiteGPT")
 
-html2text_tramsformer = Html2TextTransformer()
-
-
 with st.sidebar:
     url = st.text_input(
         "URL 주소를 적어주세요",
         placeholder="https://example.com/sitemap.xml",
     )
-
-# if url:
-#     loader = AsyncChromiumLoader([url])
-#     docs = loader.load()
-#     st.write(docs)
-#     html2text_tramsformer.transform_documents(docs)
-#     text_maker = html2text.HTML2Text()
-#     text = text_maker.handle(
-#         docs[0].page_content,
-#     )
-#     st.write(text)
-
+    if st.button("웹사이트 다시 읽기"):
+        load_website.clear()
 
 if url:
     if ".xml" not in url:
         with st.sidebar:
             st.error("Sitemap URL 을 적어주세요")
     else:
-        retriever = load_website(url)
+        retriever, index_version = load_website(url)
         query = st.text_input("웹 사이트에 대해 궁금한 점을 물어보세요")
         if query:
-            chain = (
-                {
+            answer_cache = SemanticCache(
+                url, OpenAIEmbeddings(), threshold=ANSWER_CACHE_THRESHOLD
+            )
+            answer, query_vector = answer_cache.lookup(index_version, query)
+            if answer:
+                st.markdown(answer.replace("$", "\$"))
+            else:
+                chain = {
                     "docs": retriever,
                     "question": RunnablePassthrough(),
-                }
-                | RunnableLambda(get_answers)
-                | RunnableLambda(choose_answer)
-            )
+                } | RunnableLambda(get_answers)
 
-            result = chain.invoke(query)
-            st.markdown(result.content.replace("$", "\$"))
+                answers = chain.invoke(query)
+                result = choose_answer(answers)
+                # An answer built without every source may be worse, don't reuse it.
+                if answers["complete"]:
+                    answer_cache.update(
+                        index_version, query, query_vector, result.content
+                    )
 
 else:
     st.markdown(
@@ -216,3 +283,5 @@ else:
         Start by writing the URL of the website on the sidebar.
         """
     )
+
+record_rerun("SiteGPT", rerun_started_at)
@@ -1,71 +1,301 @@
+import fcntl
 import glob
-import math
+import hashlib
+import json
+import shutil
 import subprocess
-from langchain.chat_models import ChatOpenAI
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain.document_loaders import TextLoader
+from langchain.embeddings import OpenAIEmbeddings
 from langchain.prompts import ChatPromptTemplate
-from langchain.schema import StrOutputParser
+from langchain.schema import Document, StrOutputParser
+from langchain.schema.runnable import RunnableLambda, RunnablePassthrough
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.vectorstores.faiss import FAISS
 import openai
-from pydub import AudioSegment
 import streamlit as st
 import os
+from utils.llm_cache import NamespacedChatOpenAI, setup_llm_cache
+from utils.resources import get_resource, record_rerun
+from utils.sqlite_store import cached_embeddings
 
+rerun_started_at = time.perf_counter()
 
-llm = ChatOpenAI(
-    temperature=0.1,
+setup_llm_cache()
+
+
+llm = get_resource(
+    "MeetingGPT.llm",
+    lambda: NamespacedChatOpenAI(temperature=0.1, cache_namespace="MeetingGPT"),
 )
 
-has_transcript = os.path.exists("./.cache/podcast.txt")
+MEETINGS_DIR = "./.cache/meetings"
+MAX_JOBS = 20
+JOB_TTL = 7 * 24 * 60 * 60
+
 
+def evict_jobs(current_job_dir):
+    job_dirs = sorted(
+        glob.glob(f"{MEETINGS_DIR}/*/"),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for i, job_dir in enumerate(job_dirs):
+        if os.path.normpath(job_dir) == os.path.normpath(current_job_dir):
+            continue
+        if i >= MAX_JOBS or time.time() - os.path.getmtime(job_dir) > JOB_TTL:
+            shutil.rmtree(job_dir, ignore_errors=True)
 
-@st.cache_data()
-def transcribe_chunks(chunk_folder, destination):
-    if has_transcript:
-        return
-    files = glob.glob(f"{chunk_folder}/*.mp3")
-    files.sort()
 
-    for file in files:
-        with open(file, "rb") as audio_file, open(destination, "a") as text_file:
-            transcript = openai.Audio.transcribe(
-                "whisper-1",
-                audio_file,
-            )
-            text_file.write(transcript["text"])
+TRANSCRIBE_WORKERS = 4
+TRANSCRIBE_RETRIES = 3
+
 
+def transcribe_chunk(chunk_path, cache_folder):
+    with open(chunk_path, "rb") as audio_file:
+        audio_hash = hashlib.sha256(audio_file.read()).hexdigest()
+    cache_path = f"{cache_folder}/{audio_hash}.json"
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    for attempt in range(TRANSCRIBE_RETRIES):
+        try:
+            with open(chunk_path, "rb") as audio_file:
+                response = openai.Audio.transcribe(
+                    "whisper-1",
+                    audio_file,
+                    response_format="verbose_json",
+                )
+            break
+        except openai.error.OpenAIError:
+            if attempt == TRANSCRIBE_RETRIES - 1:
+                raise
+            time.sleep(2**attempt)
+    transcript = {
+        "text": response["text"],
+        "segments": [
+            {"start": segment["start"], "text": segment["text"]}
+            for segment in response["segments"]
+        ],
+    }
+    os.makedirs(cache_folder, exist_ok=True)
+    with open(f"{cache_path}.tmp", "w") as f:
+        json.dump(transcript, f)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return transcript
 
-@st.cache_data()
-def cut_audio_in_chunks(audio_path, chunk_size, chunks_folder):
-    if has_transcript:
-        return
-    track = AudioSegment.from_mp3(audio_path)
-    chunk_len = chunk_size * 60 * 1000
-    chunks = math.ceil(len(track) / chunk_len)
 
-    for i in range(chunks):
-        start_time = i * chunk_len
-        end_time = (i + 1) * chunk_len
-        chunk = track[start_time:end_time]
-        chunk.export(f"{chunks_folder}/chunk_{str(i).zfill(2)}.mp3", format="mp3")
+# Whisper rejects files over 25MB, keep some headroom.
+MAX_CHUNK_BYTES = 24 * 1024 * 1024
+AUDIO_BITRATE = 64_000
+# Audio is sped up before transcription, timestamps are scaled back.
+ATEMPO = 1.5
+QA_CHUNK_SIZE = 1000
 
 
-@st.cache_data()
-def extract_audio_from_video(video_path):
-    if has_transcript:
-        return
-    audio_path = video_path.replace("mp4", "mp3")
+def segment_audio(video_path, chunk_size, chunks_folder):
+    segment_time = min(chunk_size * 60, MAX_CHUNK_BYTES * 8 / AUDIO_BITRATE)
+    # ffmpeg prints every finished segment to stdout, so segments can be
+    # transcribed while the rest of the video is still being decoded.
     command = [
         "ffmpeg",
         "-i",
         video_path,
         "-vn",
-        audio_path,
         "-af",
-        "atempo=1.5",
+        f"atempo={ATEMPO}",
+        "-b:a",
+        str(AUDIO_BITRATE),
+        "-f",
+        "segment",
+        "-segment_time",
+        str(segment_time),
+        "-segment_list",
+        "pipe:1",
+        "-segment_list_type",
+        "csv",
+        "-reset_timestamps",
+        "1",
+        f"{chunks_folder}/chunk_%03d.mp3",
         "-y",
     ]
-    subprocess.run(command)
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    for line in process.stdout:
+        filename, start, _ = line.strip().split(",")
+        yield os.path.join(chunks_folder, os.path.basename(filename)), float(start)
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def format_timestamp(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def transcript_docs(transcript, start):
+    docs = []
+    for segment in transcript["segments"]:
+        text = segment["text"].strip()
+        if docs and len(docs[-1].page_content) + len(text) < QA_CHUNK_SIZE:
+            docs[-1].page_content += f" {text}"
+        else:
+            docs.append(
+                Document(
+                    page_content=text,
+                    metadata={"start": (start + segment["start"]) * ATEMPO},
+                )
+            )
+    return docs
+
+
+def transcribe_video(video_path, chunk_size, job_dir, status):
+    # Transcribed chunks live with the job, so an interrupted run resumes
+    # where it stopped and evict_jobs removes them with the rest of the job.
+    transcripts_folder = f"{job_dir}/transcripts"
+    index_path = f"{job_dir}/index"
+    transcript_path = f"{job_dir}/transcript.txt"
+    embeddings = OpenAIEmbeddings()
+    embeddings_cache = cached_embeddings(embeddings, embeddings.model)
+    vector_store = None
+    # Audio segments only live in a private folder until they are transcribed.
+    work_folder = tempfile.mkdtemp(dir=job_dir)
+    try:
+        with ThreadPoolExecutor(max_workers=TRANSCRIBE_WORKERS) as executor:
+            futures = {}
+            for chunk_path, start in segment_audio(video_path, chunk_size, work_folder):
+                futures[
+                    executor.submit(transcribe_chunk, chunk_path, transcripts_folder)
+                ] = start
+                status.update(
+                    label=f"Extracting audio... ({len(futures)} segments sent to transcription)"
+                )
+            # Each transcribed chunk is indexed right away for the Q&A tab.
+            for done, future in enumerate(as_completed(futures), start=1):
+                docs = transcript_docs(future.result(), futures[future])
+                if docs and vector_store is None:
+                    vector_store = FAISS.from_documents(docs, embeddings_cache)
+                elif docs:
+                    vector_store.add_documents(docs)
+                status.update(label=f"Transcribing audio... ({done}/{len(futures)})")
+            texts = [future.result()["text"] for future in futures]
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    if vector_store is not None:
+        shutil.rmtree(index_path, ignore_errors=True)
+        vector_store.save_local(index_path)
+    with open(f"{transcript_path}.tmp", "w") as text_file:
+        text_file.write("".join(texts))
+    os.replace(f"{transcript_path}.tmp", transcript_path)
+
+
+@st.cache_data(show_spinner="Loading transcript index...")
+def load_transcript_index(index_path):
+    embeddings = OpenAIEmbeddings()
+    vector_store = FAISS.load_local(index_path, embeddings)
+    return vector_store.as_retriever()
+
+
+def format_transcript(docs):
+    return "\n\n".join(
+        f"[{format_timestamp(doc.metadata['start'])}] {doc.page_content}"
+        for doc in docs
+    )
+
+
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            """
+            Answer the question using ONLY the following meeting transcript excerpts. If you don't know the answer just say you don't know. DO NOT make anything up.
+            Every excerpt starts with its [HH:MM:SS] timestamp, cite the timestamps of the excerpts you used.
+
+            ------
+            Transcript: {context}
+            """,
+        ),
+        ("human", "{question}"),
+    ]
+)
+
+
+SUMMARY_CONCURRENCY = 8
+REDUCE_TOKEN_BUDGET = 3000
+
+first_summary_prompt = ChatPromptTemplate.from_template(
+    """
+    Write a concise summary of the following:
+    "{context}"
+    CONCISE SUMMARY:
+    """
+)
+
+combine_prompt = ChatPromptTemplate.from_template(
+    """
+    The following are summaries of consecutive parts of a meeting:
+    "{context}"
+    Combine them into a single concise summary that keeps their order.
+    CONCISE SUMMARY:
+    """
+)
+
+
+def summarize_chunks(docs, job_dir):
+    cache_path = f"{job_dir}/summaries.json"
+    summaries = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            summaries = json.load(f)
+    keys = [hashlib.sha1(doc.page_content.encode()).hexdigest() for doc in docs]
+    missing = [(key, doc) for key, doc in zip(keys, docs) if key not in summaries]
+    if missing:
+        first_summary_chain = first_summary_prompt | llm | StrOutputParser()
+        results = first_summary_chain.batch(
+            [{"context": doc.page_content} for _, doc in missing],
+            config={"max_concurrency": SUMMARY_CONCURRENCY},
+        )
+        summaries.update((key, result) for (key, _), result in zip(missing, results))
+        with open(f"{cache_path}.tmp", "w") as f:
+            json.dump(summaries, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return [summaries[key] for key in keys]
+
+
+def group_by_tokens(summaries):
+    groups = [[]]
+    tokens = 0
+    for summary in summaries:
+        summary_tokens = llm.get_num_tokens(summary)
+        # Groups hold at least two summaries so every round shrinks the list.
+        if len(groups[-1]) >= 2 and tokens + summary_tokens > REDUCE_TOKEN_BUDGET:
+            groups.append([])
+            tokens = 0
+        groups[-1].append(summary)
+        tokens += summary_tokens
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        last = groups.pop()
+        groups[-1] += last
+    return groups
+
+
+def reduce_summaries(summaries, status):
+    combine_chain = combine_prompt | llm | StrOutputParser()
+    while len(summaries) > 1:
+        groups = group_by_tokens(summaries)
+        status.update(label=f"Combining {len(summaries)} summaries...")
+        summaries = combine_chain.batch(
+            [{"context": "\n\n".join(group)} for group in groups],
+            config={"max_concurrency": SUMMARY_CONCURRENCY},
+        )
+    return summaries[0]
 
 
 st.set_page_config(
@@ -91,20 +321,28 @@ with st.sidebar:
 
 
 if video:
-    chunks_folder = "./.cache/chunks"
     with st.status("Loading video...") as status:
         video_content = video.read()
-        video_path = f"./.cache/{video.name}"
-        audio_path = video_path.replace("mp4", "mp3")
-        transcript_path = video_path.replace("mp4", "txt")
-        with open(video_path, "wb") as f:
-            f.write(video_content)
-        status.update(label="Extracting audio...")
-        extract_audio_from_video(video_path)
-        status.update(label="Cutting audio segments...")
-        cut_audio_in_chunks(audio_path, 10, chunks_folder)
-        status.update(label="Transcribing audio...")
-        transcribe_chunks(chunks_folder, transcript_path)
+        job_dir = f"{MEETINGS_DIR}/{hashlib.sha256(video_content).hexdigest()}"
+        transcript_path = f"{job_dir}/transcript.txt"
+        os.makedirs(job_dir, exist_ok=True)
+        os.utime(job_dir)
+        evict_jobs(job_dir)
+        # Only one session transcribes an upload, the others wait for its
+        # transcript instead of overwriting the video and chunks under it.
+        with open(f"{job_dir}/.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                status.update(label="Another session is transcribing this video...")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(transcript_path):
+                video_path = f"{job_dir}/video{os.path.splitext(video.name)[1]}"
+                with open(video_path, "wb") as f:
+                    f.write(video_content)
+                status.update(label="Extracting audio...")
+                transcribe_video(video_path, 10, job_dir, status)
+                os.remove(video_path)
 
     transcript_tab, summary_tab, qa_tab = st.tabs(
         [
@@ -119,6 +357,11 @@ if video:
             st.write(file.read())
 
     with summary_tab:
+        mode = st.radio(
+            "Summary mode",
+            ["Map-reduce", "Refine"],
+            horizontal=True,
+        )
         start = st.button("Generate Summary")
 
         if start:
@@ -129,40 +372,59 @@ if video:
             )
             docs = loader.load_and_split(text_splitter=splitter)
 
-            first_summary_prompt = ChatPromptTemplate.from_template(
-                """
-                Write a concise summary of the following:
-                "{context}"
-                CONCISE SUMMARY:
-                """
-            )
-            first_summary_chain = first_summary_prompt | llm | StrOutputParser()
-
-            summary = first_summary_chain.invoke({"context": docs[0].page_content})
-
-            refine_prompt = ChatPromptTemplate.from_template(
-                """
-                Your job is to produce a final summary.
-                We have provided an existing summary up to a certain point: {existing_summary}
-                We have the opportunity to refine the existing summary (only if needed) with some more context below.
-                ------------
-                {context}
-                ------------
-                Given the new context, refine the original summary.
-                If the context isn't useful, RETURN the original summary.
-                """
-            )
+            if mode == "Map-reduce":
+                with st.status("Summarizing...") as status:
+                    status.update(label=f"Summarizing {len(docs)} documents...")
+                    summary = reduce_summaries(summarize_chunks(docs, job_dir), status)
+                st.write(summary)
+            else:
+                first_summary_chain = first_summary_prompt | llm | StrOutputParser()
+
+                summary = first_summary_chain.invoke({"context": docs[0].page_content})
+
+                refine_prompt = ChatPromptTemplate.from_template(
+                    """
+                    Your job is to produce a final summary.
+                    We have provided an existing summary up to a certain point: {existing_summary}
+                    We have the opportunity to refine the existing summary (only if needed) with some more context below.
+                    ------------
+                    {context}
+                    ------------
+                    Given the new context, refine the original summary.
+                    If the context isn't useful, RETURN the original summary.
+                    """
+                )
+
+                refined_chain = refine_prompt | llm | StrOutputParser()
+
+                with st.status("Summarizing...") as status:
+                    for i, doc in enumerate(docs[1:]):
+                        status.update(label=f"Processing document {i+1}/{len(docs)-1}")
+                        summary = refined_chain.invoke(
+                            {
+                                "existing_summary": summary,
+                                "context": doc.page_content,
+                            }
+                        )
+                st.write(summary)
+
+    with qa_tab:
+        index_path = f"{job_dir}/index"
+        if not os.path.exists(index_path):
+            st.write("Nothing was said in this video.")
+        else:
+            question = st.text_input("Ask anything about the meeting")
+            if question:
+                chain = (
+                    {
+                        "context": load_transcript_index(index_path)
+                        | RunnableLambda(format_transcript),
+                        "question": RunnablePassthrough(),
+                    }
+                    | qa_prompt
+                    | llm
+                    | StrOutputParser()
+                )
+                st.write(chain.invoke(question))
 
-            refined_chain = refine_prompt | llm | StrOutputParser()
-
-            with st.status("Summarizing...") as status:
-                for i, doc in enumerate(docs[1:]):
-                    status.update(label=f"Processing document {i+1}/{len(docs)-1}")
-                    summary = refined_chain.invoke(
-                        {
-                            "existing_summary": summary,
-                            "context": doc.page_content,
-                        }
-                    )
-                    st.write(summary)
-            st.write(summary)
+record_rerun("MeetingGPT", rerun_started_at)
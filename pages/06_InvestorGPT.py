@@ -1,26 +1,69 @@
 import os
+import time
+from contextlib import contextmanager
 from typing import Any, Type
 from langchain.agents import AgentType, Tool, initialize_agent
 from langchain.schema import SystemMessage
-from langchain.utilities import DuckDuckGoSearchAPIWrapper
-from langchain.chat_models import ChatOpenAI
 from langchain.tools import BaseTool
+from langchain.tools.base import ToolException
 from pydantic import BaseModel, Field
-import requests
 import streamlit as st
 import asyncio
+from utils.alpha_vantage import AlphaVantageError, get_client
+from utils.callbacks import StreamingCallbackHandler
+from utils.llm_cache import NamespacedChatOpenAI, setup_llm_cache
+from utils.market_data import MarketDataError, get_store
+from utils.resources import get_resource, lazy_import, record_rerun
+from utils.stock_digest import income_digest, weekly_digest
 
+rerun_started_at = time.perf_counter()
 
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+setup_llm_cache()
 
 
-llm = ChatOpenAI(
-    temperature=0.1,
-    model_name="gpt-3.5-turbo-0125",
-)
+class AgentCallbackHandler(StreamingCallbackHandler):
+    # Streamlit elements can only be updated from the script thread, so the
+    # async callback manager must not move this handler to an executor.
+    run_inline = True
+
+    def __init__(self, status):
+        self.status = status
+        self.tools = {}
+        self.message = ""
+        self.message_box = None
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self.tools[run_id] = (serialized["name"], time.perf_counter())
+        self.status.update(label=f"Running {serialized['name']}...")
+        self.status.write(f"🔧 `{serialized['name']}` {input_str}")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        name, started_at = self.tools.pop(run_id)
+        self.status.write(f"✅ `{name}` {time.perf_counter() - started_at:.1f}s")
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        name, started_at = self.tools.pop(run_id)
+        self.status.write(f"❌ `{name}` {error}")
+
+    def show(self, message):
+        if self.message_box is None:
+            self.status.update(label="Writing the recommendation...")
+            self.message_box = st.empty()
+        self.message_box.markdown(message.replace("$", "\$"))
+
 
 alpha_vantage_api_key = os.environ.get("ALPHA_VANTAGE_API_KEY")
+market_data = get_store(get_client(alpha_vantage_api_key))
+
+
+@contextmanager
+def tool_errors():
+    # Tools are built with handle_tool_error, so the agent reads the error as
+    # an observation and can try another symbol instead of failing the run.
+    try:
+        yield
+    except (AlphaVantageError, MarketDataError) as e:
+        raise ToolException(str(e)) from e
 
 
 class StockMarketSymbolSearchToolArgsSchema(BaseModel):
@@ -40,8 +83,8 @@ class StockMarketSymbolSearchTool(BaseTool):
     )
 
     def _run(self, query):
-        ddg = DuckDuckGoSearchAPIWrapper()
-        return ddg.run(query)
+        ddg = lazy_import("langchain.utilities", "DuckDuckGoSearchAPIWrapper")()
+        return market_data.search_symbol(query, ddg.run)
 
 
 class CompanyOverviewArgsSchema(BaseModel):
@@ -59,69 +102,124 @@ class CompanyOverviewTool(BaseTool):
     args_schema: Type[CompanyOverviewArgsSchema] = CompanyOverviewArgsSchema
 
     def _run(self, symbol):
-        r = requests.get(
-            f"https://www.alphavantage.co/query?function=OVERVIEW&symbol={symbol}&apikey={alpha_vantage_api_key}"
-        )
-        return r.json()
+        with tool_errors():
+            return market_data.get("OVERVIEW", symbol)
+
+    async def _arun(self, symbol):
+        with tool_errors():
+            return await market_data.aget("OVERVIEW", symbol)
 
 
 class CompanyIncomeStatementTool(BaseTool):
     name = "CompanyIncomeStatement"
     description = """
     Use this to get the income statement of a company.
+    It returns the yearly revenue, margins and their year over year changes.
     You should enter a stock symbol.
     """
     args_schema: Type[CompanyOverviewArgsSchema] = CompanyOverviewArgsSchema
 
     def _run(self, symbol):
-        r = requests.get(
-            f"https://www.alphavantage.co/query?function=INCOME_STATEMENT&symbol={symbol}&apikey={alpha_vantage_api_key}"
-        )
-        return r.json()["annualReports"]
+        with tool_errors():
+            response = market_data.get("INCOME_STATEMENT", symbol)
+        return income_digest(response["annualReports"])
+
+    async def _arun(self, symbol):
+        with tool_errors():
+            response = await market_data.aget("INCOME_STATEMENT", symbol)
+        return income_digest(response["annualReports"])
 
 
 class CompanyStockPerformanceTool(BaseTool):
     name = "CompanyStockPerformance"
     description = """
     Use this to get the weekly performance of a company stock.
+    It returns returns over several horizons, volatility, drawdown and moving averages.
     You should enter a stock symbol.
     """
     args_schema: Type[CompanyOverviewArgsSchema] = CompanyOverviewArgsSchema
 
     def _run(self, symbol):
-        r = requests.get(
-            f"https://www.alphavantage.co/query?function=TIME_SERIES_WEEKLY&symbol={symbol}&apikey={alpha_vantage_api_key}"
-        )
-        response = r.json()
-        return list(response["Weekly Time Series"].items)[:200]
-
-
-agent = initialize_agent(
-    llm=llm,
-    verbose=True,
-    agent=AgentType.OPENAI_FUNCTIONS,
-    tools=[
-        StockMarketSymbolSearchTool(),
-        CompanyOverviewTool(),
-        CompanyIncomeStatementTool(),
-        CompanyStockPerformanceTool(),
-    ],
-    agent_kwargs={
-        "system_message": SystemMessage(
-            content="""
-            You are a hedge fund manager for Korean.
-
-            You evaluate a company and provide your opinion and reasons why the stock is a buy or not.
-
-            Consider the performance of a stock, the company overview and the income statement.
-
-            Be assertive in your judgement and recommend the stock or advise the user against it.
+        with tool_errors():
+            response = market_data.get("TIME_SERIES_WEEKLY_ADJUSTED", symbol)
+        return weekly_digest(response["Weekly Adjusted Time Series"])
+
+    async def _arun(self, symbol):
+        with tool_errors():
+            response = await market_data.aget("TIME_SERIES_WEEKLY_ADJUSTED", symbol)
+        return weekly_digest(response["Weekly Adjusted Time Series"])
+
+
+RESEARCH_FUNCTIONS = ["OVERVIEW", "INCOME_STATEMENT", "TIME_SERIES_WEEKLY_ADJUSTED"]
+
+
+def format_research(overview, income_statement, weekly):
+    return {
+        "overview": overview,
+        "income_statement": income_digest(income_statement["annualReports"]),
+        "stock_performance": weekly_digest(weekly["Weekly Adjusted Time Series"]),
+    }
+
+
+class CompanyResearchTool(BaseTool):
+    name = "CompanyResearch"
+    description = """
+    Use this to get the overview, the income statement and the weekly stock performance of a company at once.
+    Prefer this over calling the other company tools one by one.
+    You should enter a stock symbol.
+    """
+    args_schema: Type[CompanyOverviewArgsSchema] = CompanyOverviewArgsSchema
+
+    def _run(self, symbol):
+        with tool_errors():
+            responses = market_data.get_many(RESEARCH_FUNCTIONS, symbol)
+        return format_research(*responses)
+
+    async def _arun(self, symbol):
+        with tool_errors():
+            responses = await market_data.aget_many(RESEARCH_FUNCTIONS, symbol)
+        return format_research(*responses)
+
+
+def build_agent():
+    llm = NamespacedChatOpenAI(
+        temperature=0.1,
+        cache_namespace="InvestorGPT",
+        model_name="gpt-3.5-turbo-0125",
+        streaming=True,
+    )
+    return initialize_agent(
+        llm=llm,
+        verbose=True,
+        agent=AgentType.OPENAI_FUNCTIONS,
+        tools=[
+            StockMarketSymbolSearchTool(),
+            CompanyResearchTool(handle_tool_error=True),
+            CompanyOverviewTool(handle_tool_error=True),
+            CompanyIncomeStatementTool(handle_tool_error=True),
+            CompanyStockPerformanceTool(handle_tool_error=True),
+        ],
+        agent_kwargs={
+            "system_message": SystemMessage(
+                content="""
+                You are a hedge fund manager for Korean.
+
+                You evaluate a company and provide your opinion and reasons why the stock is a buy or not.
+
+                Consider the performance of a stock, the company overview and the income statement.
+
+                Once you know the stock symbol, get all of them in one step with the CompanyResearch tool.
+
+                Be assertive in your judgement and recommend the stock or advise the user against it.
             
-            Please reply in English and translate in Korean.
-            """,
-        )
-    },
-)
+                Please reply in English and translate in Korean.
+                """,
+            )
+        },
+    )
+
+
+agent = get_resource("InvestorGPT.agent", build_agent)
 
 
 st.set_page_config(
@@ -142,7 +240,26 @@ st.markdown(
 company = st.text_input("Write the name of the company you are interested on.")
 
 if company:
-    result = agent.invoke(
-        f"Give me information on {company}'s stock, considering it's finalcials, income statements, stock performance and help me analyze if it's a potential good investment."
-    )
-    st.write(result["output"].replace("$", "\$"))
+    started_at = time.perf_counter()
+    status = st.status("Researching...", expanded=True)
+    handler = AgentCallbackHandler(status)
+    try:
+        result = asyncio.run(
+            agent.ainvoke(
+                f"Give me information on {company}'s stock, considering it's finalcials, income statements, stock performance and help me analyze if it's a potential good investment.",
+                config={"callbacks": [handler]},
+            )
+        )
+    except Exception as e:
+        status.update(label="Research failed", state="error", expanded=True)
+        st.error(e)
+    else:
+        status.update(
+            label=f"Research finished in {time.perf_counter() - started_at:.1f}s",
+            state="complete",
+            expanded=False,
+        )
+        if not handler.message:
+            st.write(result["output"].replace("$", "\$"))
+
+record_rerun("InvestorGPT", rerun_started_at)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import threading
+from collections import Counter
+
+import aiohttp
+
+from utils.db import retry_after
+
+logger = logging.getLogger(__name__)
+
+# Point this at a local stub to run InvestorGPT without the real API.
+ALPHA_VANTAGE_BASE_URL = os.environ.get(
+    "ALPHA_VANTAGE_BASE_URL", "https://www.alphavantage.co/query"
+)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AlphaVantageError(Exception):
+    pass
+
+
+class AlphaVantageClient:
+    """Alpha Vantage client sharing one keep-alive connection pool.
+
+    The session lives on a private event loop thread so the synchronous agent
+    tools and async callers can both use it.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        base_url=ALPHA_VANTAGE_BASE_URL,
+        max_connections=8,
+        timeout=15,
+        max_retries=3,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = Counter()
+        self._session = None
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(
+            target=self._loop.run_forever, name="alpha-vantage", daemon=True
+        ).start()
+
+    async def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, keepalive_timeout=60
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _fetch(self, function, symbol):
+        session = await self._get_session()
+        params = {"function": function, "symbol": symbol, "apikey": self.api_key or ""}
+        for attempt in range(self.max_retries + 1):
+            delay = 2**attempt
+            try:
+                async with session.get(self.base_url, params=params) as response:
+                    self.stats["requests"] += 1
+                    if response.status in RETRY_STATUSES:
+                        delay = (
+                            retry_after(response.headers.get("Retry-After")) or delay
+                        )
+                        raise AlphaVantageError(f"HTTP {response.status}")
+                    response.raise_for_status()
+                    data = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, AlphaVantageError) as e:
+                error = e
+            else:
+                if "Error Message" in data:
+                    raise AlphaVantageError(data["Error Message"])
+                if not data:
+                    # Unknown symbols come back as an empty object.
+                    raise AlphaVantageError(f"No {function} data for {symbol}")
+                # Throttled and premium-only calls are answered with a 200 and
+                # a note or an information message instead of the data.
+                message = data.get("Note") or data.get("Information")
+                if message is None:
+                    return data
+                error = AlphaVantageError(message)
+            if attempt == self.max_retries:
+                break
+            self.stats["retries"] += 1
+            logger.warning(
+                "%s %s failed (%s), retrying in %ss", function, symbol, error, delay
+            )
+            await asyncio.sleep(delay)
+        raise error
+
+    async def _fetch_many(self, functions, symbol):
+        return await asyncio.gather(
+            *(self._fetch(function, symbol) for function in functions)
+        )
+
+    def _submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def submit(self, function, symbol):
+        """Start a fetch and return its concurrent.futures.Future."""
+        return self._submit(self._fetch(function, symbol))
+
+    def fetch(self, function, symbol):
+        return self.submit(function, symbol).result()
+
+    def fetch_many(self, functions, symbol):
+        return self._submit(self._fetch_many(functions, symbol)).result()
+
+    async def afetch(self, function, symbol):
+        return await asyncio.wrap_future(self.submit(function, symbol))
+
+    async def afetch_many(self, functions, symbol):
+        return await asyncio.wrap_future(
+            self._submit(self._fetch_many(functions, symbol))
+        )
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=ALPHA_VANTAGE_BASE_URL):
+    with _clients_lock:
+        if (api_key, base_url) not in _clients:
+            _clients[(api_key, base_url)] = AlphaVantageClient(api_key, base_url)
+        return _clients[(api_key, base_url)]
@@ -0,0 +1,27 @@
+from langchain.callbacks.base import BaseCallbackHandler
+
+
+class StreamingCallbackHandler(BaseCallbackHandler):
+    """Collects the streamed answer and hands it to `show` as it grows."""
+
+    message = ""
+
+    def on_llm_start(self, *args, **kwargs):
+        self.message = ""
+
+    def on_llm_new_token(self, token, *args, **kwargs):
+        # Function calls stream no content, only the final answer does.
+        if not token:
+            return
+        self.message += token
+        self.show(self.message)
+
+    def on_llm_end(self, response, *args, **kwargs):
+        text = response.generations[0][0].text
+        if not self.message and text:
+            # Responses served from the LLM cache arrive without tokens.
+            self.message = text
+            self.show(self.message)
+
+    def show(self, message):
+        raise NotImplementedError
@@ -0,0 +1,8 @@
+import hashlib
+import json
+
+
+def index_key(content, **settings):
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
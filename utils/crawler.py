@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+
+from utils.db import retry_after
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "FullstackGPT-SiteGPT"
+
+
+class HostLimiter:
+    def __init__(self, concurrency, requests_per_second):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.interval = 1 / requests_per_second
+        self.next_request_at = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            delay = self.next_request_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_request_at = time.monotonic() + self.interval
+
+    def back_off(self, seconds):
+        self.next_request_at = max(self.next_request_at, time.monotonic() + seconds)
+
+
+class Crawler:
+    def __init__(
+        self,
+        max_connections=64,
+        per_host_concurrency=8,
+        per_host_requests_per_second=8,
+        timeout=30,
+        max_retries=3,
+        verify_ssl=True,
+    ):
+        self.max_connections = max_connections
+        self.per_host_concurrency = per_host_concurrency
+        self.per_host_requests_per_second = per_host_requests_per_second
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.verify_ssl = verify_ssl
+        self.stats = Counter()
+
+    async def _robots(self, session, host_url, robots):
+        if host_url not in robots:
+            parser = RobotFileParser()
+            try:
+                async with session.get(f"{host_url}/robots.txt") as response:
+                    if response.status >= 400:
+                        parser.allow_all = True
+                    else:
+                        parser.parse((await response.text()).splitlines())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                parser.allow_all = True
+            robots[host_url] = parser
+        return robots[host_url]
+
+    def _limiter(self, host_url, robots, limiters):
+        if host_url not in limiters:
+            limiter = HostLimiter(
+                self.per_host_concurrency, self.per_host_requests_per_second
+            )
+            crawl_delay = robots.crawl_delay(USER_AGENT)
+            if crawl_delay:
+                limiter.interval = max(limiter.interval, float(crawl_delay))
+            limiters[host_url] = limiter
+        return limiters[host_url]
+
+    async def _fetch(self, session, url, validators, robots, limiters, robots_lock):
+        parts = urlsplit(url)
+        host_url = f"{parts.scheme}://{parts.netloc}"
+        async with robots_lock:
+            host_robots = await self._robots(session, host_url, robots)
+            limiter = self._limiter(host_url, host_robots, limiters)
+        if not host_robots.can_fetch(USER_AGENT, url):
+            self.stats["disallowed"] += 1
+            return {"url": url, "status": None, "error": "disallowed by robots.txt"}
+
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        async with limiter.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await limiter.wait()
+                try:
+                    async with session.get(url, headers=headers) as response:
+                        # Only throttling and server errors are worth retrying,
+                        # a dead link would back off the whole host for nothing.
+                        retryable = response.status == 429 or response.status >= 500
+                        if retryable and attempt < self.max_retries:
+                            delay = retry_after(response.headers.get("Retry-After"))
+                            limiter.back_off(delay if delay is not None else 2**attempt)
+                            self.stats["retries"] += 1
+                            continue
+                        if response.status >= 400:
+                            self.stats["errors"] += 1
+                            logger.warning(
+                                f"Failed to fetch {url}: HTTP {response.status}"
+                            )
+                            return {
+                                "url": url,
+                                "status": None,
+                                "error": f"HTTP {response.status}",
+                            }
+                        if response.status == 304:
+                            self.stats["not_modified"] += 1
+                            text = None
+                        else:
+                            self.stats["fetched"] += 1
+                            text = await response.text()
+                        return {
+                            "url": url,
+                            "status": response.status,
+                            "text": text,
+                            "etag": response.headers.get("ETag"),
+                            "last_modified": response.headers.get("Last-Modified"),
+                        }
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.max_retries:
+                        self.stats["errors"] += 1
+                        logger.warning(f"Failed to fetch {url}: {e}")
+                        return {"url": url, "status": None, "error": str(e)}
+                    self.stats["retries"] += 1
+                    limiter.back_off(2**attempt)
+
+    async def crawl(self, urls, validators=None):
+        validators = validators or {}
+        robots = {}
+        limiters = {}
+        robots_lock = asyncio.Lock()
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.per_host_concurrency,
+            ssl=None if self.verify_ssl else False,
+        )
+        async with aiohttp.ClientSession(
+            connector=connector,
+            headers={"User-Agent": USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        ) as session:
+            tasks = [
+                asyncio.create_task(
+                    self._fetch(
+                        session,
+                        url,
+                        validators.get(url, {}),
+                        robots,
+                        limiters,
+                        robots_lock,
+                    )
+                )
+                for url in urls
+            ]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    yield await task
+            finally:
+                for task in tasks:
+                    task.cancel()
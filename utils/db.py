@@ -0,0 +1,49 @@
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    # WAL lets sessions read while another one writes.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class LocalConnection:
+    """Callable returning this thread's connection to `path`.
+
+    sqlite3 connections can't be shared between threads, so each thread opens
+    its own on first use. Pickling keeps only the path, st.cache_data pickles
+    retrievers that hold a store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect(self.path)
+        return conn
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+def retry_after(value):
+    """Parse a Retry-After header into seconds, None when absent or invalid."""
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+from langchain.embeddings.base import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by every session of the process.
+
+    Each session embeds on its own event loop, so the bucket is guarded by a
+    thread lock that is never held across an await.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed * self.requests_per_minute / 60,
+        )
+        self._tokens = min(
+            self.tokens_per_minute,
+            self._tokens + elapsed * self.tokens_per_minute / 60,
+        )
+
+    async def acquire(self, tokens):
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                delay = max(
+                    (1 - self._requests) * 60 / self.requests_per_minute,
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                )
+            await asyncio.sleep(delay)
+
+
+class EmbeddingScheduler(Embeddings):
+    def __init__(
+        self,
+        embeddings,
+        max_batch_tokens=8000,
+        max_concurrency=4,
+        requests_per_minute=3000,
+        tokens_per_minute=1_000_000,
+        max_retries=5,
+    ):
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        # Requests run on this pool, which caps concurrency across sessions.
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="embeddings"
+        )
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.stats = {
+            "texts": 0,
+            "tokens": 0,
+            "batches": 0,
+            "retries": 0,
+            "seconds": 0.0,
+        }
+
+    def batches(self, texts):
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = len(self.encoding.encode(text, disallowed_special=()))
+            if batch and batch_tokens + tokens > self.max_batch_tokens:
+                yield batch, batch_tokens
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch, batch_tokens
+
+    async def _embed_batch(self, batch, tokens):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(tokens)
+            try:
+                return await loop.run_in_executor(
+                    self._executor, self.embeddings.embed_documents, batch
+                )
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats["retries"] += 1
+                delay = min(60, 2**attempt) + random.random()
+                logger.warning(f"Embedding batch failed ({e}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def aembed_documents(self, texts):
+        started_at = time.monotonic()
+        batches = list(self.batches(texts))
+        results = await asyncio.gather(
+            *(self._embed_batch(batch, tokens) for batch, tokens in batches)
+        )
+        self.stats["texts"] += len(texts)
+        self.stats["tokens"] += sum(tokens for _, tokens in batches)
+        self.stats["batches"] += len(batches)
+        self.stats["seconds"] += time.monotonic() - started_at
+        logger.info(self.report())
+        return [vector for result in results for vector in result]
+
+    def embed_documents(self, texts):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aembed_documents(texts))
+        # Already inside an event loop, run the scheduler on its own thread.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.aembed_documents(texts)).result()
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.embed_query, text
+        )
+
+    def report(self):
+        seconds = self.stats["seconds"] or 1e-9
+        return (
+            f"Embedded {self.stats['texts']} texts in {self.stats['batches']} batches "
+            f"({self.stats['texts'] / seconds:.1f} texts/s, "
+            f"{self.stats['tokens'] / seconds:.0f} tokens/s, "
+            f"{self.stats['retries']} retries)"
+        )
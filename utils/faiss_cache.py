@@ -0,0 +1,35 @@
+import os
+import pickle
+import shutil
+
+import faiss
+from langchain.vectorstores.faiss import FAISS
+
+
+def load_index(folder_path, embeddings):
+    index_path = os.path.join(folder_path, "index.faiss")
+    docstore_path = os.path.join(folder_path, "index.pkl")
+    if not (os.path.exists(index_path) and os.path.exists(docstore_path)):
+        return None
+    try:
+        index = faiss.read_index(
+            index_path,
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+    except RuntimeError:
+        # Not every index type can be memory-mapped, fall back to a full read.
+        index = faiss.read_index(index_path)
+    with open(docstore_path, "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+
+def save_index(vector_store, folder_path):
+    tmp_path = f"{folder_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    vector_store.save_local(tmp_path)
+    try:
+        os.rename(tmp_path, folder_path)
+    except OSError:
+        # Another session saved the same index first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
@@ -0,0 +1,98 @@
+import math
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain.document_loaders import UnstructuredFileLoader
+from langchain.vectorstores.faiss import FAISS
+from pypdf import PdfReader, PdfWriter
+
+PAGES_PER_PART = 10
+EMBEDDING_BATCH_SIZE = 256
+
+
+def _load_part(part_path, source):
+    docs = UnstructuredFileLoader(part_path).load()
+    for doc in docs:
+        doc.metadata["source"] = source
+    if part_path != source:
+        os.remove(part_path)
+    return docs
+
+
+def _split_pdf(file_path, reader, pages_per_part):
+    for start in range(0, len(reader.pages), pages_per_part):
+        writer = PdfWriter()
+        for page in reader.pages[start : start + pages_per_part]:
+            writer.add_page(page)
+        part_path = f"{file_path}.part{start:05d}.pdf"
+        with open(part_path, "wb") as f:
+            writer.write(f)
+        yield part_path
+
+
+def _parts(file_path, pages_per_part):
+    """Return the number of parts and an iterator over their paths."""
+    if file_path.lower().endswith(".pdf"):
+        reader = PdfReader(file_path)
+        count = math.ceil(len(reader.pages) / pages_per_part)
+        return count, _split_pdf(file_path, reader, pages_per_part)
+    return 1, iter([file_path])
+
+
+def _mp_context():
+    # Forking the multi-threaded Streamlit server, with its open sqlite
+    # connections, can deadlock the children.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def iter_chunks(
+    file_path,
+    text_splitter,
+    max_workers=None,
+    pages_per_part=PAGES_PER_PART,
+):
+    count, parts = _parts(file_path, pages_per_part)
+    if count <= 1:
+        # Not worth starting a worker process for a single part.
+        for part_path in parts:
+            yield from text_splitter.split_documents(_load_part(part_path, file_path))
+        return
+    # The pool starts all its workers on the first submit, never start more
+    # than there are parts.
+    max_workers = min(max_workers or os.cpu_count() or 1, count)
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=_mp_context()
+    ) as executor:
+        pending = deque()
+        for part_path in parts:
+            pending.append(executor.submit(_load_part, part_path, file_path))
+            # Keep only a few parts in flight so memory stays bounded.
+            if len(pending) >= max_workers * 2:
+                yield from text_splitter.split_documents(pending.popleft().result())
+        while pending:
+            yield from text_splitter.split_documents(pending.popleft().result())
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_vector_store(chunks, embeddings, batch_size=EMBEDDING_BATCH_SIZE):
+    vector_store = None
+    for batch in batched(chunks, batch_size):
+        if vector_store is None:
+            vector_store = FAISS.from_documents(batch, embeddings)
+        else:
+            vector_store.add_documents(batch)
+    return vector_store
@@ -0,0 +1,106 @@
+import re
+import threading
+from collections import Counter
+
+from langchain.cache import SQLAlchemyCache
+from langchain.chat_models import ChatOpenAI
+from langchain.globals import set_llm_cache
+from sqlalchemy import create_engine, event, text
+
+LLM_CACHE_DB = "./cache.db"
+
+# Oldest responses are evicted past this many cached generations.
+MAX_ENTRIES = 50_000
+
+# The namespace rides in the model's llm_string, see NamespacedChatOpenAI.
+NAMESPACE_PATTERN = re.compile(r'"cache_namespace": "([^"]*)"')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def _set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+class NamespacedSQLiteCache(SQLAlchemyCache):
+    def __init__(self, database_path=LLM_CACHE_DB, max_entries=MAX_ENTRIES):
+        engine = create_engine(
+            f"sqlite:///{database_path}",
+            pool_size=8,
+            max_overflow=8,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(engine, "connect", _set_pragmas)
+        super().__init__(engine)
+        self.max_entries = max_entries
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def lookup(self, prompt, llm_string):
+        value = super().lookup(prompt, llm_string)
+        match = NAMESPACE_PATTERN.search(llm_string)
+        namespace = match.group(1) if match else "default"
+        with self._stats_lock:
+            self.stats[f"{namespace}:{'hits' if value else 'misses'}"] += 1
+        return value
+
+    def update(self, prompt, llm_string, return_val):
+        super().update(prompt, llm_string, return_val)
+        self._evict()
+
+    def _evict(self):
+        with self.engine.begin() as conn:
+            count = conn.execute(text("SELECT COUNT(*) FROM full_llm_cache")).scalar()
+            if count > self.max_entries:
+                conn.execute(
+                    text(
+                        """
+                        DELETE FROM full_llm_cache WHERE rowid IN (
+                            SELECT rowid FROM full_llm_cache ORDER BY rowid LIMIT :n
+                        )
+                        """
+                    ),
+                    {"n": count - self.max_entries},
+                )
+
+    def hit_rate(self, namespace):
+        with self._stats_lock:
+            hits = self.stats[f"{namespace}:hits"]
+            misses = self.stats[f"{namespace}:misses"]
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def hit_rates(self):
+        with self._stats_lock:
+            namespaces = {key.split(":")[0] for key in self.stats}
+        return {namespace: self.hit_rate(namespace) for namespace in namespaces}
+
+
+class NamespacedChatOpenAI(ChatOpenAI):
+    """ChatOpenAI whose cache entries are kept apart per page.
+
+    The namespace is a constructor argument, so it is serialized into the
+    llm_string the cache keys on, also for calls Runnable.batch or worker
+    threads make outside the page's context. It is never sent to OpenAI.
+    """
+
+    cache_namespace: str = "default"
+
+
+def setup_llm_cache():
+    global _cache
+    # Every page calls this on each rerun, the cache itself is created once
+    # per process and shared by all sessions.
+    with _cache_lock:
+        if _cache is None:
+            _cache = NamespacedSQLiteCache()
+            set_llm_cache(_cache)
+    return _cache
+
+
+def hit_rates():
+    return _cache.hit_rates() if _cache else {}
@@ -0,0 +1,196 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from utils.db import LocalConnection
+
+logger = logging.getLogger(__name__)
+
+MARKET_DATA_DB = "./.cache/market_data.db"
+DAY = 24 * 60 * 60
+# Weekly prices move daily, statements only change every quarter.
+TTLS = {
+    "OVERVIEW": DAY,
+    "TIME_SERIES_WEEKLY_ADJUSTED": DAY,
+    "INCOME_STATEMENT": 90 * DAY,
+}
+DEFAULT_TTL = DAY
+# Only payloads that carry their data are cached, never throttling notes or
+# the empty object returned for unknown symbols.
+EXPECTED_KEYS = {
+    "OVERVIEW": "Symbol",
+    "TIME_SERIES_WEEKLY_ADJUSTED": "Weekly Adjusted Time Series",
+    "INCOME_STATEMENT": "annualReports",
+}
+SYMBOL_SEARCH_TTL = 30 * DAY
+# Stale entries are served while a refresh runs in the background, until they
+# are this many TTLs old.
+MAX_STALE_TTLS = 7
+
+
+class MarketDataError(Exception):
+    pass
+
+
+def _is_valid(function, payload):
+    key = EXPECTED_KEYS.get(function)
+    return bool(payload) and (key is None or key in payload)
+
+
+class MarketDataStore:
+    def __init__(self, client, path=MARKET_DATA_DB):
+        self.client = client
+        self.path = path
+        self.stats = Counter()
+        self._connection = LocalConnection(path)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS market_data (
+                    function TEXT NOT NULL,
+                    symbol TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (function, symbol)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS symbol_searches (
+                    query TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    fetched_at REAL NOT NULL
+                ) WITHOUT ROWID
+                """
+            )
+
+    def _read(self, function, symbol):
+        return (
+            self._connection()
+            .execute(
+                "SELECT payload, fetched_at FROM market_data WHERE function = ? AND symbol = ?",
+                [function, symbol],
+            )
+            .fetchone()
+        )
+
+    def _write(self, function, symbol, payload):
+        if not _is_valid(function, payload):
+            raise MarketDataError(
+                f"Unexpected {function} response for {symbol}: {str(payload)[:200]}"
+            )
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO market_data VALUES (?, ?, ?, ?)",
+                [function, symbol, json.dumps(payload), time.time()],
+            )
+
+    def _refresh(self, function, symbol):
+        with self._lock:
+            if (function, symbol) in self._refreshing:
+                return
+            self._refreshing.add((function, symbol))
+        self.stats["refreshes"] += 1
+
+        def done(future):
+            try:
+                self._write(function, symbol, future.result())
+            except Exception as e:
+                logger.warning("Refreshing %s %s failed: %s", function, symbol, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard((function, symbol))
+
+        self.client.submit(function, symbol).add_done_callback(done)
+
+    def _cached(self, function, symbol):
+        """Return the cached payload, or None when it has to be fetched."""
+        row = self._read(function, symbol)
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        payload, fetched_at = row
+        payload = json.loads(payload)
+        if not _is_valid(function, payload):
+            # Written before payloads were validated, fetch it again.
+            self.stats["misses"] += 1
+            return None
+        age = time.time() - fetched_at
+        ttl = TTLS.get(function, DEFAULT_TTL)
+        if age <= ttl:
+            self.stats["hits"] += 1
+        elif age <= ttl * MAX_STALE_TTLS:
+            self.stats["stale_hits"] += 1
+            self._refresh(function, symbol)
+        else:
+            self.stats["misses"] += 1
+            return None
+        return payload
+
+    def get_many(self, functions, symbol):
+        symbol = symbol.upper()
+        results = {function: self._cached(function, symbol) for function in functions}
+        missing = [function for function, data in results.items() if data is None]
+        if missing:
+            for function, data in zip(missing, self.client.fetch_many(missing, symbol)):
+                self._write(function, symbol, data)
+                results[function] = data
+        return [results[function] for function in functions]
+
+    async def aget_many(self, functions, symbol):
+        symbol = symbol.upper()
+        results = {function: self._cached(function, symbol) for function in functions}
+        missing = [function for function, data in results.items() if data is None]
+        if missing:
+            for function, data in zip(
+                missing, await self.client.afetch_many(missing, symbol)
+            ):
+                self._write(function, symbol, data)
+                results[function] = data
+        return [results[function] for function in functions]
+
+    def get(self, function, symbol):
+        return self.get_many([function], symbol)[0]
+
+    async def aget(self, function, symbol):
+        return (await self.aget_many([function], symbol))[0]
+
+    def search_symbol(self, query, search):
+        key = " ".join(query.lower().split())
+        row = (
+            self._connection()
+            .execute(
+                "SELECT result FROM symbol_searches WHERE query = ? AND fetched_at > ?",
+                [key, time.time() - SYMBOL_SEARCH_TTL],
+            )
+            .fetchone()
+        )
+        if row:
+            self.stats["search_hits"] += 1
+            return row[0]
+        self.stats["search_misses"] += 1
+        result = search(query)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO symbol_searches VALUES (?, ?, ?)",
+                [key, result, time.time()],
+            )
+        return result
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(client, path=MARKET_DATA_DB):
+    with _stores_lock:
+        if (id(client), path) not in _stores:
+            _stores[(id(client), path)] = MarketDataStore(client, path)
+        return _stores[(id(client), path)]
@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from utils.db import LocalConnection
+
+logger = logging.getLogger(__name__)
+
+QUIZ_DB = "./.cache/quiz.db"
+BANK_SIZE = 3
+
+
+class QuizStore:
+    def __init__(self, path=QUIZ_DB, bank_size=BANK_SIZE):
+        self.path = path
+        self.bank_size = bank_size
+        self._connection = LocalConnection(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS quizzes (
+                    key TEXT NOT NULL,
+                    quiz TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS quizzes_key ON quizzes (key)")
+
+    def quizzes(self, key):
+        rows = (
+            self._connection()
+            .execute(
+                "SELECT quiz FROM quizzes WHERE key = ? ORDER BY created_at", [key]
+            )
+            .fetchall()
+        )
+        return [json.loads(quiz) for quiz, in rows]
+
+    def pick(self, key, exclude=None):
+        # Prefer a quiz the user has not seen yet so retries stay varied.
+        quizzes = self.quizzes(key)
+        unseen = [quiz for quiz in quizzes if quiz != exclude]
+        return random.choice(unseen) if unseen else None
+
+    def is_full(self, key):
+        return len(self.quizzes(key)) >= self.bank_size
+
+    def add(self, key, quiz):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO quizzes VALUES (?, ?, ?)",
+                [key, json.dumps(quiz, ensure_ascii=False), time.time()],
+            )
+            # Keep only the newest quizzes of the bank.
+            conn.execute(
+                """
+                DELETE FROM quizzes WHERE key = ? AND rowid NOT IN (
+                    SELECT rowid FROM quizzes WHERE key = ?
+                    ORDER BY created_at DESC LIMIT ?
+                )
+                """,
+                [key, key, self.bank_size],
+            )
+
+
+def fill_bank(store, key, generate):
+    while not store.is_full(key):
+        store.add(key, generate(store.quizzes(key)))
+
+
+def start_pregeneration(store, topics, prepare):
+    """Fill the quiz bank of every topic in a daemon thread.
+
+    `prepare(topic)` returns the store key and a `generate(previous_quizzes)`
+    callable for it.
+    """
+
+    def run():
+        for topic in topics:
+            try:
+                key, generate = prepare(topic)
+                fill_bank(store, key, generate)
+            except Exception as e:
+                logger.warning("Pregenerating a quiz for %s failed: %s", topic, e)
+
+    thread = threading.Thread(target=run, name="quiz-pregeneration", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,125 @@
+import importlib
+import math
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+PROFILE_RERUNS = os.environ.get("PROFILE_RERUNS") == "1"
+MAX_RERUN_SAMPLES = 200
+HEAVY_MODULES = [
+    "langchain.chat_models",
+    "langchain.agents",
+    "langchain.document_loaders",
+    "langchain.retrievers",
+    "langchain.utilities",
+    "langchain.vectorstores.faiss",
+    "openai",
+    "utils.ingest",
+    "utils.site_index",
+]
+
+_resources = {}
+_lock = threading.RLock()
+import_times = {}
+build_times = {}
+rerun_times = defaultdict(lambda: deque(maxlen=MAX_RERUN_SAMPLES))
+first_rerun_times = {}
+
+
+def lazy_import(name, attribute=None):
+    """Import a module on first use, optionally returning one of its attributes."""
+    module = sys.modules.get(name)
+    if module is None:
+        started_at = time.perf_counter()
+        module = importlib.import_module(name)
+        import_times.setdefault(name, time.perf_counter() - started_at)
+    return getattr(module, attribute) if attribute else module
+
+
+def get_resource(key, factory):
+    """Return the object registered under `key`, building it on first use.
+
+    Streamlit re-executes a page on every interaction, so models and agents
+    built here are shared by every rerun and session of the process.
+    """
+    with _lock:
+        if key not in _resources:
+            started_at = time.perf_counter()
+            _resources[key] = factory()
+            build_times[key] = time.perf_counter() - started_at
+        return _resources[key]
+
+
+def record_rerun(page, started_at):
+    elapsed = time.perf_counter() - started_at
+    # The first rerun pays for imports, keep it once the samples roll over.
+    first_rerun_times.setdefault(page, elapsed)
+    rerun_times[page].append(elapsed)
+
+
+def _milliseconds(seconds):
+    return round(seconds * 1000, 1)
+
+
+def report():
+    reruns = {}
+    for page, samples in rerun_times.items():
+        ordered = sorted(samples)
+        reruns[page] = {
+            "runs": len(ordered),
+            "first_ms": _milliseconds(first_rerun_times[page]),
+            "last_ms": _milliseconds(samples[-1]),
+            "median_ms": _milliseconds(statistics.median(ordered)),
+            "p95_ms": _milliseconds(ordered[math.ceil(0.95 * len(ordered)) - 1]),
+        }
+    return {
+        "imports_ms": {
+            name: _milliseconds(seconds) for name, seconds in import_times.items()
+        },
+        "resources_ms": {
+            key: _milliseconds(seconds) for key, seconds in build_times.items()
+        },
+        "reruns": reruns,
+        "caches": _cache_report(),
+    }
+
+
+def _cache_report():
+    # Only report caches a page already loaded, the report stays import-free.
+    caches = {}
+    llm_cache = sys.modules.get("utils.llm_cache")
+    if llm_cache:
+        caches["llm_hit_rates"] = llm_cache.hit_rates()
+    sqlite_store = sys.modules.get("utils.sqlite_store")
+    if sqlite_store:
+        caches["embeddings"] = sqlite_store.cache_stats()
+    return caches
+
+
+def cold_import_times(modules=HEAVY_MODULES):
+    """Time each import in a fresh interpreter so shared dependencies count."""
+    times = {}
+    for name in modules:
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import time; t = time.perf_counter(); import {name}; "
+                "print(time.perf_counter() - t)",
+            ],
+            capture_output=True,
+            text=True,
+        )
+        times[name] = (
+            _milliseconds(float(result.stdout)) if result.returncode == 0 else None
+        )
+    return times
+
+
+if __name__ == "__main__":
+    for name, milliseconds in cold_import_times(sys.argv[1:] or HEAVY_MODULES).items():
+        print(f"{name}: {'failed' if milliseconds is None else f'{milliseconds}ms'}")
@@ -0,0 +1,98 @@
+import os
+import time
+
+import numpy as np
+
+from utils.db import LocalConnection
+
+SEMANTIC_CACHE_DB = "./.cache/semantic_cache.db"
+# ada-002 cosine scores bunch between about 0.7 and 1.0, so unrelated questions
+# on the same topic easily clear 0.9. Only near rewordings should hit.
+DEFAULT_THRESHOLD = 0.97
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        namespace,
+        embeddings,
+        path=SEMANTIC_CACHE_DB,
+        threshold=DEFAULT_THRESHOLD,
+        ttl=24 * 60 * 60,
+    ):
+        self.namespace = namespace
+        self.embeddings = embeddings
+        self.path = path
+        self.threshold = threshold
+        self.ttl = ttl
+        self._connection = LocalConnection(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS answers (
+                    namespace TEXT NOT NULL,
+                    index_version TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    answer TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS answers_namespace ON answers (namespace, index_version)"
+            )
+
+    def lookup(self, index_version, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        rows = (
+            self._connection()
+            .execute(
+                """
+            SELECT embedding, answer FROM answers
+            WHERE namespace = ? AND index_version = ? AND created_at > ?
+            """,
+                [self.namespace, index_version, time.time() - self.ttl],
+            )
+            .fetchall()
+        )
+        if not rows:
+            return None, vector
+        matrix = np.stack(
+            [np.frombuffer(embedding, dtype=np.float32) for embedding, _ in rows]
+        )
+        scores = (
+            matrix
+            @ vector
+            / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector) + 1e-10)
+        )
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None, vector
+        return rows[best][1], vector
+
+    def update(self, index_version, question, vector, answer):
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM answers WHERE namespace = ? AND created_at <= ?",
+                [self.namespace, time.time() - self.ttl],
+            )
+            conn.execute(
+                "INSERT INTO answers VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    self.namespace,
+                    index_version,
+                    question,
+                    np.asarray(vector, dtype=np.float32).tobytes(),
+                    answer,
+                    time.time(),
+                ],
+            )
+
+    def invalidate(self, index_version):
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM answers WHERE namespace = ? AND index_version != ?",
+                [self.namespace, index_version],
+            )
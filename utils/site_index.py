@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+
+from bs4 import BeautifulSoup
+from langchain.document_loaders import SitemapLoader
+from langchain.schema import Document
+from langchain.vectorstores.faiss import FAISS
+
+from utils.crawler import Crawler
+
+SITES_DIR = "./.cache/sites"
+
+
+def _site_dir(sitemap_url):
+    return os.path.join(SITES_DIR, hashlib.sha1(sitemap_url.encode()).hexdigest())
+
+
+def _load_state(site_dir, embeddings):
+    state_path = os.path.join(site_dir, "state.json")
+    if not os.path.exists(state_path):
+        return None, {}
+    with open(state_path) as f:
+        state = json.load(f)
+    vector_store = None
+    if os.path.exists(os.path.join(site_dir, "index.faiss")):
+        vector_store = FAISS.load_local(site_dir, embeddings)
+    return vector_store, state
+
+
+def _save_state(site_dir, vector_store, state):
+    tmp_dir = f"{site_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    if vector_store is not None:
+        vector_store.save_local(tmp_dir)
+    with open(os.path.join(tmp_dir, "state.json"), "w") as f:
+        json.dump(state, f)
+    shutil.rmtree(site_dir, ignore_errors=True)
+    os.rename(tmp_dir, site_dir)
+
+
+def index_version(state):
+    pages = sorted((url, page["hash"]) for url, page in state.items())
+    return hashlib.sha1(json.dumps(pages).encode()).hexdigest()
+
+
+def _split_page(url, lastmod, html, parsing_function, text_splitter):
+    text = parsing_function(BeautifulSoup(html, "html.parser"))
+    content_hash = hashlib.sha1(text.encode()).hexdigest()
+    chunks = text_splitter.split_documents(
+        [
+            Document(
+                page_content=text,
+                metadata={"source": url, "lastmod": lastmod or ""},
+            )
+        ]
+    )
+    return content_hash, chunks
+
+
+async def _refresh_pages(crawler, entries, state, parsing_function, text_splitter):
+    loop = asyncio.get_running_loop()
+    docs = []
+    ids = []
+    stale_ids = []
+    validators = {url: state[url] for url in entries if url in state}
+    # Pages are parsed and split on worker threads as soon as they arrive,
+    # while the crawler keeps fetching the rest.
+    async for result in crawler.crawl(list(entries), validators):
+        url = result["url"]
+        entry = entries[url]
+        page = state.get(url)
+        if result["status"] is None:
+            continue
+        if result["status"] == 304:
+            page["lastmod"] = entry.get("lastmod")
+            continue
+        content_hash, chunks = await loop.run_in_executor(
+            None,
+            _split_page,
+            url,
+            entry.get("lastmod"),
+            result["text"],
+            parsing_function,
+            text_splitter,
+        )
+        cache_headers = {
+            "etag": result["etag"],
+            "last_modified": result["last_modified"],
+        }
+        if page and page["hash"] == content_hash:
+            page.update(lastmod=entry.get("lastmod"), **cache_headers)
+            continue
+        if page:
+            stale_ids += page["ids"]
+        page_ids = [f"{url}#{content_hash}-{i}" for i in range(len(chunks))]
+        state[url] = {
+            "lastmod": entry.get("lastmod"),
+            "hash": content_hash,
+            "ids": page_ids,
+            **cache_headers,
+        }
+        docs += chunks
+        ids += page_ids
+    return docs, ids, stale_ids
+
+
+def update_site_index(
+    sitemap_url,
+    parsing_function,
+    text_splitter,
+    embeddings,
+    crawler=None,
+):
+    site_dir = _site_dir(sitemap_url)
+    vector_store, state = _load_state(site_dir, embeddings)
+    crawler = crawler or Crawler(verify_ssl=False)
+    loader = SitemapLoader(sitemap_url, restrict_to_same_domain=False)
+    loader.requests_kwargs = {"verify": False}
+    entries = {
+        entry["loc"]: entry
+        for entry in loader.parse_sitemap(loader.scrape(parser="xml"))
+    }
+
+    stale_ids = []
+    for url in set(state) - set(entries):
+        stale_ids += state.pop(url)["ids"]
+
+    # Pages without a lastmod can't be skipped up front, a conditional
+    # request or their content hash decides whether they are re-embedded.
+    candidates = {
+        url: entry
+        for url, entry in entries.items()
+        if url not in state
+        or not entry.get("lastmod")
+        or entry.get("lastmod") != state[url]["lastmod"]
+    }
+    docs, ids, changed_ids = asyncio.run(
+        _refresh_pages(crawler, candidates, state, parsing_function, text_splitter)
+    )
+    stale_ids += changed_ids
+
+    if vector_store is not None and stale_ids:
+        vector_store.delete(stale_ids)
+    if docs:
+        if vector_store is None:
+            vector_store = FAISS.from_documents(docs, embeddings, ids=ids)
+        else:
+            vector_store.add_documents(docs, ids=ids)
+    _save_state(site_dir, vector_store, state)
+    stats = {
+        "pages": len(entries),
+        "fetched": crawler.stats["fetched"],
+        "not_modified": crawler.stats["not_modified"],
+        "updated": len({doc.metadata["source"] for doc in docs}),
+        "chunks_deleted": len(stale_ids),
+        "chunks_added": len(docs),
+    }
+    return vector_store, index_version(state), stats
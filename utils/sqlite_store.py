@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.embeddings.cache import _create_key_encoder
+from langchain.schema.storage import BaseStore
+from langchain.storage.encoder_backed import EncoderBackedStore
+
+from utils.db import LocalConnection
+
+EMBEDDINGS_DB = "./.cache/embeddings.db"
+
+# SQLite limits the number of bound parameters per statement.
+MAX_VARIABLES = 500
+
+# Least recently used rows are evicted past this many cached vectors.
+MAX_ITEMS = 100_000
+
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def cache_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def pack_vector(vector):
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(value):
+    vector = array("f")
+    vector.frombytes(value)
+    return vector.tolist()
+
+
+class SQLiteByteStore(BaseStore[str, bytes]):
+    def __init__(self, path=EMBEDDINGS_DB, namespace="", max_items=MAX_ITEMS):
+        self.path = path
+        self.namespace = namespace
+        self.max_items = max_items
+        self._connection = LocalConnection(path)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    last_used REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+                """
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(embeddings)")]
+            if "last_used" not in columns:
+                conn.execute(
+                    "ALTER TABLE embeddings ADD COLUMN last_used REAL NOT NULL DEFAULT 0"
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+            )
+
+    def mget(self, keys):
+        values = {}
+        conn = self._connection()
+        for start in range(0, len(keys), MAX_VARIABLES):
+            batch = keys[start : start + MAX_VARIABLES]
+            placeholders = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, value FROM embeddings WHERE namespace = ? AND key IN ({placeholders})",
+                [self.namespace, *batch],
+            )
+            values.update(rows)
+        with self._connection() as conn:
+            now = time.time()
+            conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE namespace = ? AND key = ?",
+                [(now, self.namespace, key) for key in values],
+            )
+        with stats_lock:
+            stats[f"{self.namespace}:hits"] += len(values)
+            stats[f"{self.namespace}:misses"] += len(keys) - len(values)
+        return [values.get(key) for key in keys]
+
+    def mset(self, key_value_pairs):
+        with self._connection() as conn:
+            now = time.time()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (namespace, key, value, last_used) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, value, now) for key, value in key_value_pairs],
+            )
+            if self.max_items:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        (count,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count <= self.max_items:
+            return
+        conn.execute(
+            """
+            DELETE FROM embeddings WHERE (namespace, key) IN (
+                SELECT namespace, key FROM embeddings ORDER BY last_used LIMIT ?
+            )
+            """,
+            [count - self.max_items],
+        )
+        with stats_lock:
+            stats["evictions"] += count - self.max_items
+
+    def mdelete(self, keys):
+        with self._connection() as conn:
+            conn.executemany(
+                "DELETE FROM embeddings WHERE namespace = ? AND key = ?",
+                [(self.namespace, key) for key in keys],
+            )
+
+    def yield_keys(self, prefix=None):
+        rows = self._connection().execute(
+            "SELECT key FROM embeddings WHERE namespace = ? AND key LIKE ? ESCAPE '\\'",
+            [
+                self.namespace,
+                re.sub(r"([%_\\])", r"\\\1", prefix or "") + "%",
+            ],
+        )
+        for (key,) in rows:
+            yield key
+
+
+def cached_embeddings(embeddings, model, path=EMBEDDINGS_DB):
+    # One global namespace per embedding model: identical chunks from any
+    # document or site share a single cached vector.
+    store = EncoderBackedStore(
+        SQLiteByteStore(path, model),
+        # Keys are the content hash CacheBackedEmbeddings.from_bytes_store
+        # uses, so migrated LocalFileStore entries are found.
+        key_encoder=_create_key_encoder(""),
+        value_serializer=pack_vector,
+        value_deserializer=unpack_vector,
+    )
+    return CacheBackedEmbeddings(embeddings, store)
+
+
+def migrate_local_file_store(directory, model, path=EMBEDDINGS_DB):
+    store = SQLiteByteStore(path, model)
+    migrated = 0
+    for root, _, files in os.walk(directory):
+        pairs = []
+        for key in files:
+            with open(os.path.join(root, key), "rb") as f:
+                pairs.append((key, pack_vector(json.loads(f.read()))))
+        store.mset(pairs)
+        migrated += len(pairs)
+    return migrated
+
+
+if __name__ == "__main__":
+    # python -m utils.sqlite_store text-embedding-ada-002 ./.cache/embeddings
+    model = sys.argv[1]
+    for directory in sys.argv[2:]:
+        migrated = migrate_local_file_store(directory, model)
+        print(f"{directory}: {migrated} embeddings migrated")
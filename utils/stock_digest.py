@@ -0,0 +1,112 @@
+import numpy as np
+
+WEEKS_PER_YEAR = 52
+RETURN_HORIZONS = {"1w": 1, "1m": 4, "3m": 13, "6m": 26, "1y": 52, "3y": 156}
+MOVING_AVERAGES = {"10w": 10, "40w": 40}
+INCOME_YEARS = 5
+
+
+def _round(value, digits=2):
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+def _percent(value):
+    return _round(value * 100)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # Alpha Vantage reports missing figures as the string "None".
+        return np.nan
+
+
+def _max_drawdown(closes):
+    if not len(closes):
+        return np.nan
+    return np.min(closes / np.maximum.accumulate(closes) - 1)
+
+
+def weekly_digest(series):
+    """Summarize a TIME_SERIES_WEEKLY_ADJUSTED series in a few dozen numbers."""
+    dates = sorted(series)
+    if not dates:
+        return {}
+    # Adjusted closes keep splits and dividends from showing up as returns.
+    closes = np.array([_number(series[date]["5. adjusted close"]) for date in dates])
+    highs = np.array([_number(series[date]["2. high"]) for date in dates])
+    lows = np.array([_number(series[date]["3. low"]) for date in dates])
+    volumes = np.array([_number(series[date]["6. volume"]) for date in dates])
+    log_returns = np.diff(np.log(closes))
+    last_year = closes[-(WEEKS_PER_YEAR + 1) :]
+    return {
+        "from": dates[0],
+        "to": dates[-1],
+        "weeks": len(dates),
+        "last_close": _round(closes[-1]),
+        "returns_percent": {
+            horizon: _percent(closes[-1] / closes[-1 - weeks] - 1)
+            for horizon, weeks in RETURN_HORIZONS.items()
+            if weeks < len(closes)
+        },
+        "annualized_volatility_percent": _percent(
+            np.std(log_returns[-WEEKS_PER_YEAR:], ddof=1) * np.sqrt(WEEKS_PER_YEAR)
+            if len(log_returns) > 1
+            else np.nan
+        ),
+        "max_drawdown_percent": {
+            "1y": _percent(_max_drawdown(last_year)),
+            "all": _percent(_max_drawdown(closes)),
+        },
+        # Traded prices, intraweek extremes are not adjusted.
+        "52w_high": _round(highs[-WEEKS_PER_YEAR:].max()),
+        "52w_low": _round(lows[-WEEKS_PER_YEAR:].min()),
+        "moving_averages": {
+            name: {
+                "value": _round(closes[-weeks:].mean()),
+                "price_vs_average_percent": _percent(
+                    closes[-1] / closes[-weeks:].mean() - 1
+                ),
+            }
+            for name, weeks in MOVING_AVERAGES.items()
+            if weeks <= len(closes)
+        },
+        "average_weekly_volume_3m": _round(volumes[-13:].mean(), 0),
+    }
+
+
+def income_digest(reports):
+    """Reduce annual income statements to revenue, margins and their changes."""
+    reports = sorted(reports, key=lambda report: report["fiscalDateEnding"])
+    reports = reports[-(INCOME_YEARS + 1) :]
+    if not reports:
+        return []
+    revenue, gross, operating, net = (
+        np.array([_number(report[field]) for report in reports])
+        for field in ("totalRevenue", "grossProfit", "operatingIncome", "netIncome")
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        margins = {
+            "gross": gross / revenue,
+            "operating": operating / revenue,
+            "net": net / revenue,
+        }
+        revenue_growth = np.concatenate([[np.nan], revenue[1:] / revenue[:-1] - 1])
+    digest = []
+    # The oldest year only serves as the base of the first year-over-year delta.
+    for i in range(1 if len(reports) > 1 else 0, len(reports)):
+        year = {
+            "fiscal_date_ending": reports[i]["fiscalDateEnding"],
+            "revenue_millions": _round(revenue[i] / 1e6, 1),
+            "net_income_millions": _round(net[i] / 1e6, 1),
+            "revenue_yoy_percent": _percent(revenue_growth[i]),
+        }
+        for name, margin in margins.items():
+            year[f"{name}_margin_percent"] = _percent(margin[i])
+            year[f"{name}_margin_change_pp"] = (
+                _percent(margin[i] - margin[i - 1]) if i else None
+            )
+        digest.append(year)
+    return digest